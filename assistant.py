@@ -10,11 +10,15 @@ VENV_DIR = Path.home() / ".openams_env"
 VENV_PYTHON = VENV_DIR / "bin" / "python"
 
 if sys.executable != str(VENV_PYTHON):
-    # Not running in venv: ensure venv exists and rich is installed, then re-exec
+    # Not running in venv: ensure venv exists with its requirements installed, then re-exec
+    import openams_deps
     if not VENV_DIR.exists():
-        subprocess.run(["python3", "-m", "venv", str(VENV_DIR)], check=True)
-        subprocess.run([str(VENV_PYTHON), "-m", "pip", "install", "--upgrade", "pip"], check=True)
-        subprocess.run([str(VENV_PYTHON), "-m", "pip", "install", "click", "rich"], check=True)
+        openams_deps.create_venv(VENV_DIR)
+    try:
+        openams_deps.ensure(VENV_DIR)
+    except openams_deps.DepsError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
     # Re-exec this script in the venv
     os.execv(str(VENV_PYTHON), [str(VENV_PYTHON)] + sys.argv)
 
@@ -24,6 +28,9 @@ from rich.progress import Progress, SpinnerColumn, TextColumn, TimeElapsedColumn
 from rich.prompt import Confirm, Prompt
 from rich.table import Table
 
+import openams_netlink
+import openams_usb
+
 # --- Ensure venv site-packages is in sys.path ---
 site_packages = None
 if VENV_DIR.exists():
@@ -111,12 +118,10 @@ def wait_for_dfu():
         transient=True
     ) as progress:
         task = progress.add_task("[cyan]Waiting for STM32 device in DFU mode...", start=False)
-        while True:
-            result = subprocess.run(["dfu-util", "-l"], capture_output=True, text=True)
-            if "Found DFU: [0483:df11]" in result.stdout:
-                progress.update(task, description="[green]DFU device detected!")
-                break
-            time.sleep(1)
+        # Blocks on kernel uevents; returns as soon as 0483:df11 enumerates
+        device = openams_usb.wait_for_device([openams_usb.DFU_ID])
+        progress.update(task, description="[green]DFU device detected!")
+    log(f"DFU device: {device.describe()}")
 
 def wait_for_can_bridge():
     with Progress(
@@ -125,21 +130,42 @@ def wait_for_can_bridge():
         transient=True
     ) as progress:
         task = progress.add_task("[cyan]Waiting for CAN bridge (can0)...", start=False)
-        while True:
-            result = subprocess.run(["ip", "link", "show", "can0"], capture_output=True, text=True)
-            if result.returncode == 0:
-                progress.update(task, description="[green]CAN bridge detected!")
-                break
-            time.sleep(1)
-
-def query_uuid():
-    result = subprocess.run(
-        [str(VENV_PYTHON), str(Path(__file__).parent / "openams_cli.py"), "query"],
-        capture_output=True, text=True
-    )
-    import re
-    uuids = re.findall(r'canbus_uuid=([0-9a-fA-F]+)', result.stdout)
-    return uuids
+        # Blocks on rtnetlink link events; returns as soon as can0 registers
+        openams_netlink.wait_for_link("can0")
+        progress.update(task, description="[green]CAN bridge detected!")
+
+def query_uuid(expect=None):
+    cmd = [str(VENV_PYTHON), str(Path(__file__).parent / "openams_cli.py"), "query", "--format", "ndjson"]
+    if expect is not None:
+        cmd += ["--expect", str(expect)]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    return [json.loads(line)["uuid"] for line in result.stdout.splitlines() if line.startswith("{")]
+
+def start_background_build(mode):
+    """
+    Start building the FPS firmware for mode in the background, logging its
+    output. deploy later finds the images in the build cache.
+    """
+    cmd = [str(VENV_PYTHON), str(Path(__file__).parent / "openams_cli.py"), "build", "--mode", mode]
+    log(f"Running in background: {' '.join(cmd)}")
+    with open(LOG_PATH, "a") as log_file:
+        return subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=log_file, stderr=subprocess.STDOUT)
+
+def wait_for_background_build(process):
+    with Progress(
+        SpinnerColumn(),
+        TextColumn("[progress.description]{task.description}"),
+        TimeElapsedColumn(),
+        transient=True
+    ) as progress:
+        progress.add_task("[cyan]Waiting for FPS firmware build to finish...")
+        returncode = process.wait()
+    if returncode == 0:
+        log("Background FPS firmware build finished.")
+    else:
+        # deploy rebuilds whatever is missing from the cache
+        console.print(f"[yellow]Background build exited with {returncode}; deploy will build what is missing. See {LOG_PATH}.")
+        log(f"Background FPS firmware build failed with exit code {returncode}.")
 
 def stop_klipper():
     result = subprocess.run(["systemctl", "is-active", "klipper"], capture_output=True, text=True)
@@ -162,40 +188,69 @@ def print_summary(state):
     console.print(table)
     console.print(f"[bold blue]Log file: {LOG_PATH}")
 
-def install_openams_daemon_service():
+def install_openams_daemon_service(with_udev_rule=False):
+    """
+    Install the openams-daemon unit, activated by the can0 network device
+    rather than at boot. With with_udev_rule, also install a udev rule that
+    pulls the daemon in when the USB-to-CAN bridge (1d50:614e) registers can0.
+    """
     import shutil
 
     script_dir = Path(__file__).parent
     daemon_src = script_dir / "openams_daemon.py"
     daemon_dst = Path("/usr/local/bin/openams-daemon")
     service_dst = Path("/etc/systemd/system/openams-daemon.service")
+    udev_rule_dst = Path("/etc/udev/rules.d/90-openams-daemon.rules")
     venv_python = Path.home() / ".openams_env" / "bin" / "python"
+    can_device = "sys-subsystem-net-devices-can0.device"
 
     # Copy the daemon script and make it executable
     subprocess.run(["sudo", "cp", str(daemon_src), str(daemon_dst)], check=True)
     subprocess.run(["sudo", "chmod", "755", str(daemon_dst)], check=True)
 
     # Write the systemd service file
+    # Type=notify: the daemon reports READY=1 as soon as it is running and
+    # then pings the watchdog through CANBus discovery and Klipper setup,
+    # reporting each phase in STATUS=.
+    # The unit is bound to can0, so it only runs while the interface exists and
+    # waits for the boards without a fixed timeout.
     service_contents = f"""[Unit]
 Description=OpenAMS CANBus UUID Wait Daemon
-After=network.target
+BindsTo={can_device}
+After={can_device} network.target
 
 [Service]
-Type=simple
+Type=notify
 Environment="PATH={venv_python.parent}:$PATH"
 Environment="VIRTUAL_ENV={venv_python.parent.parent}"
+Environment="OPENAMS_HOME={script_dir.resolve()}"
+Environment="OPENAMS_DISCOVERY_TIMEOUT=0"
+WorkingDirectory={script_dir.resolve()}
 ExecStart={venv_python} {daemon_dst}
+WatchdogSec=30
 Restart=on-failure
 User={os.environ.get('USER', 'pi')}
 
 [Install]
-WantedBy=multi-user.target
+WantedBy={can_device}
 """
     subprocess.run(["sudo", "tee", str(service_dst)], input=service_contents.encode(), check=True)
     subprocess.run(["sudo", "chmod", "644", str(service_dst)], check=True)
+
+    if with_udev_rule:
+        udev_rule = (
+            'SUBSYSTEM=="net", ACTION=="add", KERNEL=="can0", '
+            'ATTRS{idVendor}=="1d50", ATTRS{idProduct}=="614e", '
+            'TAG+="systemd", ENV{SYSTEMD_WANTS}+="openams-daemon.service"\n'
+        )
+        subprocess.run(["sudo", "tee", str(udev_rule_dst)], input=udev_rule.encode(), check=True)
+        subprocess.run(["sudo", "udevadm", "control", "--reload-rules"])
+
     subprocess.run(["sudo", "systemctl", "daemon-reload"])
-    subprocess.run(["sudo", "systemctl", "enable", "--now", "openams-daemon.service"])
-    console.print("[bold green]OpenAMS Daemon service installed and started.")
+    subprocess.run(["sudo", "systemctl", "enable", "openams-daemon.service"])
+    # Start now only if can0 is already present; otherwise the device starts it
+    subprocess.run(["sudo", "systemctl", "start", "--no-block", "openams-daemon.service"])
+    console.print("[bold green]OpenAMS Daemon service installed; it starts whenever can0 appears.")
 
 def assistant():
     state = load_state()
@@ -216,6 +271,10 @@ def assistant():
     log("Python environment setup complete.")
     console.print("[bold green]Python environment setup complete.\n")
 
+    # Build the FPS firmware while the operator handles jumpers and cables
+    console.print("[cyan]Building FPS firmware in the background...")
+    build_process = start_background_build("bridge")
+
     # 2. Shutdown Klipper
     console.rule("[bold blue]Step 2/10: Stopping Klipper")
     stop_klipper()
@@ -232,6 +291,7 @@ def assistant():
 
     # 5. Flash FPS firmware
     console.rule("[bold blue]Step 5/10: Flash FPS Firmware")
+    wait_for_background_build(build_process)
     console.print("[cyan]Flashing FPS firmware...")
     run_and_log([
         str(VENV_PYTHON), str(Path(__file__).parent / "openams_cli.py"), "deploy", "--board", "fps", "--mode", "bridge", "--allow-missing-programmer"
@@ -255,7 +315,8 @@ def assistant():
     # 9. Query CANBus for FPS UUID
     console.rule("[bold blue]Step 9/10: Query FPS UUID")
     console.print("[cyan]Querying CANBus for FPS UUID...")
-    uuids = query_uuid()
+    # expect=2 still returns early when a second node answers, so that case aborts below
+    uuids = query_uuid(expect=2)
     if not uuids or len(uuids) != 1:
         console.print("[red]Could not detect FPS UUID. Aborting.")
         log("FPS UUID not found.")
@@ -276,7 +337,7 @@ def assistant():
     console.print("[cyan]Flashing mainboard firmware...")
     run_and_log([str(VENV_PYTHON), str(Path(__file__).parent / "openams_cli.py"), "deploy", "--board", "openams"])
 
-    install_openams_daemon_service()
+    install_openams_daemon_service(with_udev_rule=True)
 
     # 12. Final hardware instructions
     console.rule("[bold blue]Hardware Installation")
@@ -0,0 +1,299 @@
+"""
+Firmware build support for Katapult and Klipper.
+
+Builds run out of tree, one directory per (project, mode), so bridge and
+canbus variants stay warm side by side and repeat builds are incremental.
+Finished images go into a content-addressed cache keyed by (repo commit +
+uncommitted diff, .config contents, toolchain version), so a deploy that
+would rebuild the exact same image can skip `make` entirely. The cache is
+bounded by total size and evicts least recently used entries first.
+"""
+import hashlib
+import json
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+CACHE_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "openams" / "builds"
+BUILD_ROOT = CACHE_DIR.parent / "trees"
+MAX_CACHE_BYTES = 256 * 1024 * 1024
+TOOLCHAIN = "arm-none-eabi-gcc"
+META_FILE = "meta.json"
+# Rough peak RSS of one cc1 job on these trees, used to cap -j on small Pis
+JOB_MEMORY = 200 * 1024 * 1024
+
+
+@dataclass
+class BuildStats:
+    """Timing and compiler cache figures for one firmware build."""
+    project: str
+    cached: bool = False
+    wall: float = 0.0
+    cpu: float = 0.0
+    jobs: int = 1
+    ccache_hits: int = 0
+    ccache_misses: int = 0
+
+    @property
+    def hit_rate(self):
+        total = self.ccache_hits + self.ccache_misses
+        return self.ccache_hits / total if total else None
+
+
+def _git(repo_path, *args):
+    result = subprocess.run(["git", "-C", str(repo_path)] + list(args), capture_output=True)
+    return result.stdout if result.returncode == 0 else b""
+
+
+def toolchain_version():
+    """First line of `arm-none-eabi-gcc --version`, or "" if it is not installed."""
+    try:
+        result = subprocess.run([TOOLCHAIN, "--version"], capture_output=True, text=True)
+    except OSError:
+        return ""
+    return result.stdout.splitlines()[0] if result.stdout else ""
+
+
+def prepare_build_dir(project, mode, config_path):
+    """
+    Return (out_dir, kconfig_path) for building project in mode out of tree.
+    The config is copied in only when the source changed (make may rewrite
+    the copy via olddefconfig), so an unchanged config does not invalidate
+    every object through autoconf.h.
+    """
+    out_dir = BUILD_ROOT / f"{project}-{mode}"
+    out_dir.mkdir(parents=True, exist_ok=True)
+    kconfig = out_dir / "kconfig"
+    stamp = out_dir / "kconfig.source"
+    data = Path(config_path).read_bytes()
+    digest = hashlib.sha256(data).hexdigest()
+    if not kconfig.exists() or not stamp.exists() or stamp.read_text() != digest:
+        kconfig.write_bytes(data)
+        stamp.write_text(digest)
+    return out_dir, kconfig
+
+
+def available_memory():
+    """MemAvailable from /proc/meminfo in bytes, or None if unknown."""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def build_jobs():
+    """Parallel job count: one per CPU, capped by available memory."""
+    jobs = os.cpu_count() or 1
+    memory = available_memory()
+    if memory is not None:
+        jobs = min(jobs, memory // JOB_MEMORY)
+    return max(1, jobs)
+
+
+def _in_jobserver():
+    # A parent make already hands out job slots; let the child share them
+    makeflags = os.environ.get("MAKEFLAGS", "")
+    return "--jobserver" in makeflags or "-j" in makeflags
+
+
+def make_command(out_dir, kconfig, *targets, jobs=None):
+    """
+    make invocation using Klipper/Katapult's KCONFIG_CONFIG and OUT= support,
+    run with -j jobs unless inside a parent jobserver, and routed through
+    ccache when it is installed.
+    """
+    cmd = ["make", f"KCONFIG_CONFIG={kconfig}", f"OUT={out_dir}/"]
+    if jobs and not _in_jobserver():
+        cmd.append(f"-j{jobs}")
+    if shutil.which("ccache"):
+        cmd.append(f"CC=ccache {TOOLCHAIN}")
+    return cmd + list(targets)
+
+
+def run_command(cmd, output=None, timeout=None, **kwargs):
+    """
+    Run cmd and return (returncode, rusage) for it and the processes it
+    waited on. With output, each line of its combined stdout/stderr is
+    passed to output(line) instead of going to the terminal, so several
+    commands can run side by side with their output told apart. With
+    timeout, cmd and everything it started are killed after that many
+    seconds and subprocess.TimeoutExpired is raised.
+    """
+    if timeout is not None:
+        # Own process group, so helpers such as git-remote-https die with it
+        kwargs["start_new_session"] = True
+    if output is None:
+        process = subprocess.Popen(cmd, **kwargs)
+    else:
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   text=True, errors="replace", **kwargs)
+    timer = None
+    expired = []
+    if timeout is not None:
+        def kill():
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+                expired.append(True)
+            except ProcessLookupError:
+                pass  # Finished just in time
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    usage = None
+    try:
+        if output is not None:
+            try:
+                for line in process.stdout:
+                    output(line.rstrip("\n"))
+            finally:
+                process.stdout.close()
+        # wait4 gives this child's own resource usage, unlike RUSAGE_CHILDREN
+        _, status, usage = os.wait4(process.pid, 0)
+    finally:
+        if timer:
+            timer.cancel()
+        if usage is None:
+            # output() raised or we were interrupted: kill the child rather than leave it running unreaped
+            try:
+                if timeout is not None:
+                    os.killpg(process.pid, signal.SIGKILL)
+                else:
+                    process.kill()
+            except ProcessLookupError:
+                pass
+            _, status, _ = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if expired:
+        raise subprocess.TimeoutExpired(cmd, timeout)
+    return process.returncode, usage
+
+
+def read_ccache_statslog(path):
+    """Count (hits, misses) in a CCACHE_STATSLOG file; (0, 0) if ccache wrote none."""
+    hits = misses = 0
+    try:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line in ("direct_cache_hit", "preprocessed_cache_hit"):
+                    hits += 1
+                elif line == "cache_miss":
+                    misses += 1
+    except OSError:
+        pass
+    return hits, misses
+
+
+def run_make(project, repo_path, out_dir, kconfig, jobs=None, output=None):
+    """
+    Run the build for project and return (returncode, BuildStats) with wall
+    time, CPU time of the make process tree and the ccache hits/misses of
+    this build alone. output is passed on to run_command().
+    """
+    jobs = jobs or build_jobs()
+    stats = BuildStats(project, jobs=jobs)
+    # A per-build stats log keeps hit rates separate when builds run concurrently
+    statslog = Path(out_dir) / "ccache-stats.log"
+    if statslog.exists():
+        statslog.unlink()
+    env = dict(os.environ, CCACHE_STATSLOG=str(statslog))
+    start = time.monotonic()
+    returncode, usage = run_command(make_command(out_dir, kconfig, jobs=jobs), output=output, cwd=repo_path, env=env)
+    stats.wall = time.monotonic() - start
+    stats.cpu = usage.ru_utime + usage.ru_stime
+    stats.ccache_hits, stats.ccache_misses = read_ccache_statslog(statslog)
+    return returncode, stats
+
+
+def cache_key(project, repo_path, config_path):
+    """
+    Return (key, metadata) for building project from repo_path with
+    config_path. Local edits to tracked files are part of the key.
+    """
+    commit = _git(repo_path, "rev-parse", "HEAD").decode().strip()
+    diff = hashlib.sha256(_git(repo_path, "diff", "HEAD")).hexdigest()
+    config = hashlib.sha256(Path(config_path).read_bytes()).hexdigest()
+    toolchain = toolchain_version()
+    meta = {
+        "project": project,
+        "commit": commit,
+        "diff": diff,
+        "config": Path(config_path).name,
+        "config_sha256": config,
+        "toolchain": toolchain,
+    }
+    key = hashlib.sha256(json.dumps(meta, sort_keys=True).encode()).hexdigest()
+    return key, meta
+
+
+def lookup(key, artifact_name):
+    """Return the cached artifact path for key, or None on a miss."""
+    entry = CACHE_DIR / key
+    artifact = entry / artifact_name
+    if not artifact.exists():
+        return None
+    # Directory mtime is the LRU clock
+    os.utime(entry)
+    return artifact
+
+
+def store(key, meta, artifact_path):
+    """Copy a freshly built artifact into the cache, evict if over budget, and return the cached path."""
+    entry = CACHE_DIR / key
+    entry.mkdir(parents=True, exist_ok=True)
+    cached = entry / Path(artifact_path).name
+    tmp = cached.with_suffix(".tmp")
+    shutil.copyfile(artifact_path, tmp)
+    os.replace(tmp, cached)
+    meta = dict(meta, artifact=cached.name, created=time.time())
+    (entry / META_FILE).write_text(json.dumps(meta, indent=2))
+    gc()
+    return cached
+
+
+def read_meta(artifact_path):
+    """Return the stored metadata for a cached artifact path, or {} if it has none."""
+    try:
+        return json.loads((Path(artifact_path).parent / META_FILE).read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def entries():
+    """Return cache entries as dicts (key, size, last_used, plus stored metadata), most recent first."""
+    result = []
+    if not CACHE_DIR.exists():
+        return result
+    for entry in CACHE_DIR.iterdir():
+        if not entry.is_dir():
+            continue
+        try:
+            meta = json.loads((entry / META_FILE).read_text())
+        except (OSError, ValueError):
+            meta = {}
+        size = sum(f.stat().st_size for f in entry.iterdir() if f.is_file())
+        result.append(dict(meta, key=entry.name, size=size, last_used=entry.stat().st_mtime))
+    result.sort(key=lambda e: e["last_used"], reverse=True)
+    return result
+
+
+def gc(max_bytes=MAX_CACHE_BYTES):
+    """Evict least recently used entries until the cache fits in max_bytes. Returns evicted entries."""
+    evicted = []
+    kept = 0
+    for entry in entries():
+        if kept + entry["size"] <= max_bytes:
+            kept += entry["size"]
+            continue
+        shutil.rmtree(CACHE_DIR / entry["key"], ignore_errors=True)
+        evicted.append(entry)
+    return evicted
@@ -0,0 +1,178 @@
+"""
+In-process CANBus node discovery for Klipper/Katapult devices.
+
+Speaks the Klipper CAN admin protocol directly over a raw SocketCAN socket,
+so querying the bus needs neither python-can nor a Klipper checkout.
+Only the standard library is used here, which keeps this module cheap to
+import from the daemon and the assistant.
+"""
+import socket
+import struct
+import time
+from dataclasses import dataclass
+
+# Klipper CAN admin protocol (see klippy/extras/canbus_ids.py upstream)
+CANBUS_ID_ADMIN = 0x3f0
+CANBUS_ID_ADMIN_RESP = 0x3f1
+CMD_QUERY_UNASSIGNED = 0x00
+RESP_NEED_NODEID = 0x20
+CMD_SET_KLIPPER_NODEID = 0x01
+CMD_SET_KATAPULT_NODEID = 0x11
+
+APPLICATION_NAMES = {
+    CMD_SET_KLIPPER_NODEID: "Klipper",
+    CMD_SET_KATAPULT_NODEID: "Katapult",
+}
+
+DEFAULT_INTERFACE = "can0"
+DEFAULT_TIMEOUT = 2.0
+
+# struct can_frame: can_id, can_dlc, 3 pad bytes, 8 data bytes
+CAN_FRAME_FMT = "=IB3x8s"
+CAN_FRAME_SIZE = struct.calcsize(CAN_FRAME_FMT)
+CAN_SFF_MASK = 0x7ff
+
+
+@dataclass
+class CanNode:
+    """A node that answered the "query unassigned" admin command."""
+    uuid: str
+    application: str
+    interface: str
+    first_seen: float = 0.0  # wall clock time of the first reply
+    latency: float = 0.0  # seconds between the query and the first reply
+
+
+def open_socket(interface=DEFAULT_INTERFACE):
+    """
+    Open a raw CAN socket bound to interface, filtered to admin responses.
+    Raises OSError if SocketCAN is unavailable or the interface is missing.
+    """
+    if not hasattr(socket, "AF_CAN"):
+        raise OSError("SocketCAN is not supported on this platform")
+    sock = socket.socket(socket.AF_CAN, socket.SOCK_RAW, socket.CAN_RAW)
+    try:
+        sock.setsockopt(
+            socket.SOL_CAN_RAW, socket.CAN_RAW_FILTER,
+            struct.pack("=II", CANBUS_ID_ADMIN_RESP, CAN_SFF_MASK)
+        )
+        sock.bind((interface,))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def send_query(sock):
+    """Broadcast the "query unassigned" admin command."""
+    data = bytes([CMD_QUERY_UNASSIGNED])
+    sock.send(struct.pack(CAN_FRAME_FMT, CANBUS_ID_ADMIN, len(data), data.ljust(8, b"\x00")))
+
+
+def parse_response(frame):
+    """
+    Decode an admin response frame into (uuid, application), or None if the
+    frame is not a node id request.
+    """
+    can_id, dlc, data = struct.unpack(CAN_FRAME_FMT, frame)
+    data = data[:dlc]
+    if (can_id & CAN_SFF_MASK) != CANBUS_ID_ADMIN_RESP or dlc < 7 or data[0] != RESP_NEED_NODEID:
+        return None
+    uuid = data[1:7].hex()
+    app_id = data[7] if dlc > 7 else CMD_SET_KLIPPER_NODEID
+    return uuid, APPLICATION_NAMES.get(app_id, "Unknown")
+
+
+def discover(interface=DEFAULT_INTERFACE, timeout=DEFAULT_TIMEOUT, expect=None):
+    """
+    Query the bus once and collect every distinct node that answers within
+    timeout seconds. If expect is given, return as soon as that many distinct
+    nodes have answered instead of waiting out the whole window.
+    Returns a list of CanNode in the order they replied.
+    """
+    nodes = {}
+    with open_socket(interface) as sock:
+        send_query(sock)
+        sent = time.monotonic()
+        deadline = sent + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            sock.settimeout(remaining)
+            try:
+                frame = sock.recv(CAN_FRAME_SIZE)
+            except socket.timeout:
+                break
+            parsed = parse_response(frame)
+            if parsed is None or parsed[0] in nodes:
+                continue
+            uuid, application = parsed
+            nodes[uuid] = CanNode(
+                uuid, application, interface,
+                first_seen=time.time(), latency=time.monotonic() - sent
+            )
+            if expect is not None and len(nodes) >= expect:
+                break
+    return list(nodes.values())
+
+
+def watch(interface=DEFAULT_INTERFACE, min_interval=0.5, max_interval=5.0, miss_limit=2, duration=None):
+    """
+    Keep one socket open and re-query the bus, yielding ("node_added", node)
+    and ("node_removed", node) as nodes appear and disappear.
+
+    The query interval starts at min_interval and doubles up to max_interval
+    while the bus is quiet, dropping back to min_interval on any change. A
+    node is reported removed after miss_limit consecutive unanswered
+    queries. Note that nodes stop answering once Klipper assigns them a node
+    id, so a running Klipper host shows up here as departures.
+    If duration is given, stop after that many seconds.
+    """
+    present = {}
+    misses = {}
+    interval = min_interval
+    end = time.monotonic() + duration if duration is not None else None
+    with open_socket(interface) as sock:
+        while end is None or time.monotonic() < end:
+            send_query(sock)
+            sent = time.monotonic()
+            deadline = sent + interval
+            if end is not None:
+                deadline = min(deadline, end)
+            seen = set()
+            changed = False
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                sock.settimeout(remaining)
+                try:
+                    frame = sock.recv(CAN_FRAME_SIZE)
+                except socket.timeout:
+                    break
+                parsed = parse_response(frame)
+                if parsed is None:
+                    continue
+                uuid, application = parsed
+                seen.add(uuid)
+                if uuid not in present:
+                    node = CanNode(
+                        uuid, application, interface,
+                        first_seen=time.time(), latency=time.monotonic() - sent
+                    )
+                    present[uuid] = node
+                    changed = True
+                    yield "node_added", node
+
+            for uuid in list(present):
+                if uuid in seen:
+                    misses.pop(uuid, None)
+                    continue
+                misses[uuid] = misses.get(uuid, 0) + 1
+                if misses[uuid] >= miss_limit:
+                    del misses[uuid]
+                    changed = True
+                    yield "node_removed", present.pop(uuid)
+
+            interval = min_interval if changed else min(interval * 2, max_interval)
@@ -1,3 +1,5 @@
+import dataclasses
+import json
 import os
 import subprocess
 import sys
@@ -14,13 +16,26 @@ LICENSE_PATH = Path(__file__).parent / "LICENSE"
 LICENSE_ACCEPTED_PATH = Path(".license_accepted")
 
 APT_PACKAGES = [
-    "gcc-arm-none-eabi", "make", "dfu-util", "git", "python3-venv"
+    "gcc-arm-none-eabi", "make", "ccache", "dfu-util", "git", "python3-venv", "libusb-1.0-0"
 ]
 
+def missing_apt_packages():
+    """Return the APT_PACKAGES dpkg does not report as installed (none if dpkg is unavailable)."""
+    missing = []
+    for package in APT_PACKAGES:
+        try:
+            result = subprocess.run(["dpkg-query", "-W", "-f=${Status}", package], capture_output=True, text=True)
+        except FileNotFoundError:
+            return []
+        if "install ok installed" not in result.stdout:
+            missing.append(package)
+    return missing
+
 def require_license_agreement():
     # If the acceptance file exists, skip prompt
     if LICENSE_ACCEPTED_PATH.exists():
         return
+    from rich.prompt import Confirm
     if not LICENSE_PATH.exists():
         console.print("[bold red]LICENSE file not found. Exiting.")
         sys.exit(1)
@@ -42,15 +57,23 @@ def require_license_agreement():
 
 
 # Step 1: Minimal environment setup to bootstrap required packages
+# Bootstrap output goes to stderr so it never mixes with `query --format json|ndjson` on stdout
+import openams_deps
+
 if not ENV_DIR.exists():
-    print("[BOOTSTRAP] Installing minimal required packages...")
-    subprocess.run(["sudo", "apt", "update"])
-    subprocess.run(["sudo", "apt", "install", "-y"] + APT_PACKAGES)
+    print("[BOOTSTRAP] Installing minimal required packages...", file=sys.stderr)
+    subprocess.run(["sudo", "apt", "update"], stdout=sys.stderr)
+    subprocess.run(["sudo", "apt", "install", "-y"] + APT_PACKAGES, stdout=sys.stderr)
     
-    print("[BOOTSTRAP] Creating virtual environment at ~/.openams_env...")
-    subprocess.run(["python3", "-m", "venv", str(ENV_DIR)], check=True)
-    subprocess.run([str(VENV_PIP), "install", "--upgrade", "pip"], check=True)
-    subprocess.run([str(VENV_PIP), "install", "click", "rich"], check=True)
+    print("[BOOTSTRAP] Creating virtual environment at ~/.openams_env...", file=sys.stderr)
+    openams_deps.create_venv(ENV_DIR, stdout=sys.stderr)
+# A stamp read unless requirements.txt, the venv interpreter or the wheelhouse changed; then one pip run
+# for what is missing, with --no-index from the wheelhouse when there is one
+try:
+    openams_deps.ensure(ENV_DIR, log=lambda msg: print(f"[BOOTSTRAP] {msg}", file=sys.stderr), stdout=sys.stderr)
+except openams_deps.DepsError as e:
+    print(f"[BOOTSTRAP] {e}", file=sys.stderr)
+    sys.exit(1)
 
 # Step 2: Ensure environment is in sys.path
 activate_site = str(ENV_DIR / "lib" / f"python{sys.version_info.major}.{sys.version_info.minor}" / "site-packages")
@@ -59,19 +82,42 @@ if activate_site not in sys.path:
 
 # Step 3: Now safely import packages that require the environment
 import click
-from rich.console import Console
-from rich.prompt import Confirm, Prompt
 
-console = Console()
+import openams_build
+import openams_can
+import openams_dfu
+import openams_firmware
+import openams_image
+import openams_netlink
+import openams_release
+import openams_sources
+import openams_usb
+
+class LazyConsole:
+    """
+    Stands in for rich's Console and creates it on first use, so headless
+    runs such as query --format json|ndjson never import rich.
+    """
+    _console = None
+
+    def __getattr__(self, name):
+        if LazyConsole._console is None:
+            from rich.console import Console
+            LazyConsole._console = Console()
+        return getattr(LazyConsole._console, name)
 
-REQUIRED_PACKAGES = [
-    "click", "rich"
-]
+console = LazyConsole()
 
 
 
+# Per-build timings collected by build_firmware() for the deploy summary
+build_stats = []
+
 KATAPULT_REPO = "https://github.com/Arksine/katapult"
 KLIPPER_REPO = "https://github.com/Klipper3d/klipper"
+# Tested tag or full commit id to build from; unset follows the upstream default branch
+KATAPULT_REF = os.environ.get("OPENAMS_KATAPULT_REF")
+KLIPPER_REF = os.environ.get("OPENAMS_KLIPPER_REF")
 
 @click.group()
 @click.option(
@@ -90,6 +136,7 @@ def ensure_stm32_programmer_cli(allow_missing=False):
     If allow_missing is True, skip error if not found.
     """
     from shutil import which
+    from rich.prompt import Confirm
     arch = platform.machine()
     if arch.startswith("arm") or arch.startswith("aarch64"):
         console.print("[yellow]STM32_Programmer_CLI is not available for ARM (Raspberry Pi). Skipping installation.")
@@ -133,18 +180,37 @@ def setup(ctx, allow_missing_programmer):
     ctx.obj["allow_missing_programmer"] = allow_missing_programmer
     console.rule("[bold green]Environment Setup")
 
+    # The bootstrap only installs system packages on first run; pick up ones added since (e.g. ccache)
+    missing_apt = missing_apt_packages()
+    if missing_apt:
+        console.print(f"[bold cyan]Installing system packages: {' '.join(missing_apt)}")
+        subprocess.run(["sudo", "apt", "install", "-y"] + missing_apt)
+    if not shutil.which("ccache"):
+        console.print("[yellow]ccache is not on PATH; firmware rebuilds will not be cached by the compiler.")
+
     # Create virtual environment
     if not ENV_DIR.exists():
         console.print(f"[bold yellow]Creating virtual environment at {ENV_DIR}")
-        subprocess.run(["python3", "-m", "venv", str(ENV_DIR)])
+        openams_deps.create_venv(ENV_DIR)
     else:
         console.print(f"[green]Virtual environment already exists at {ENV_DIR}")
 
-    # Install Python packages
-    pip = ENV_DIR / "bin" / "pip"
-    console.print("[bold cyan]Installing Python packages in virtual environment...")
-    subprocess.run([str(pip), "install", "--upgrade", "pip"])
-    subprocess.run([str(pip), "install"] + REQUIRED_PACKAGES)
+    # Install whatever requirements.txt lists that the venv lacks, in one pip run
+    console.print("[bold cyan]Checking Python packages in virtual environment...")
+    try:
+        installed = openams_deps.ensure(ENV_DIR, force=True, log=lambda msg: console.print(f"[cyan]{msg}"))
+    except openams_deps.DepsError as e:
+        console.print(f"[red]{e}")
+        sys.exit(1)
+    if not installed:
+        console.print("[green]All Python packages already installed.")
+
+    # Let the in-process DFU flasher open STM32 bootloaders without sudo
+    if sys.platform.startswith("linux"):
+        console.print("[cyan]Installing udev rule for STM32 DFU access...")
+        dfu_rule = 'SUBSYSTEM=="usb", ATTRS{idVendor}=="0483", ATTRS{idProduct}=="df11", MODE="0666"\n'
+        subprocess.run(["sudo", "tee", "/etc/udev/rules.d/49-openams-dfu.rules"], input=dfu_rule.encode(), stdout=subprocess.DEVNULL)
+        subprocess.run(["sudo", "udevadm", "control", "--reload-rules"])
 
     # Ensure STM32_Programmer_CLI is installed
     ensure_stm32_programmer_cli(allow_missing=allow_missing_programmer)
@@ -158,6 +224,7 @@ def setup(ctx, allow_missing_programmer):
 )
 def setup_canbus(non_interactive):
     """Set up CANBus network on this system (systemd-networkd, udev, config, reboot)."""
+    from rich.prompt import Confirm
     console.rule("[bold blue]CANBus Network Setup")
 
     # Prompt user to plug in CANBus bridge device
@@ -172,10 +239,10 @@ def setup_canbus(non_interactive):
     # --- Check for legacy can0 setup ---
     legacy_iface_file = Path("/etc/network/interfaces.d/can0")
     interfaces_file = Path("/etc/network/interfaces")
-    can0_exists = subprocess.run(["ip", "link", "show", "can0"], capture_output=True, text=True)
+    can0_exists = openams_netlink.get_link("can0")
     legacy_config_found = False
 
-    if can0_exists.returncode == 0:
+    if can0_exists:
         # can0 interface exists, check for legacy config files
         if legacy_iface_file.exists():
             legacy_config_found = True
@@ -247,18 +314,18 @@ def setup_canbus(non_interactive):
 
     # 5. Verify CAN network interface is up
     console.print("[cyan]Verifying CAN network interface is up...")
-    can_status = subprocess.run(["ip", "link", "show", "can0"], capture_output=True, text=True)
-    if can_status.returncode == 0 and "state UP" in can_status.stdout:
-        console.print("[bold green]can0 interface is UP and ready.")
-    elif can_status.returncode == 0:
+    can_status = openams_netlink.get_link("can0")
+    if can_status and can_status.up:
+        console.print(f"[bold green]can0 interface is UP and ready ({can_status.bitrate} bit/s, {can_status.can_state or can_status.operstate}).")
+    elif can_status:
         console.print("[yellow]can0 interface found but not UP. Attempting to bring it up...")
         # Correct way: set type and bitrate before bringing up
         subprocess.run(["sudo", "ip", "link", "set", "can0", "type", "can", "bitrate", "1000000"])
         subprocess.run(["sudo", "ip", "link", "set", "can0", "up"])
-        # Re-check status
-        can_status = subprocess.run(["ip", "link", "show", "can0"], capture_output=True, text=True)
-        if "state UP" in can_status.stdout:
-            console.print("[bold green]can0 interface is now UP and ready.")
+        # Wait for the kernel to report the link as up
+        can_status = openams_netlink.wait_for_link("can0", up=True, timeout=5)
+        if can_status:
+            console.print(f"[bold green]can0 interface is now UP and ready ({can_status.bitrate} bit/s).")
         else:
             console.print("[red]Failed to bring up can0 interface. Please check your hardware and configuration.")
     else:
@@ -271,6 +338,329 @@ def setup_canbus(non_interactive):
     console.print("- Use flexible, stranded wire (22-26AWG recommended).\n")
     console.print("For more info, see: https://canbus.esoterical.online/Getting_Started.html#120r-termination-resistors and https://canbus.esoterical.online/Getting_Started.html#cabling")
 
+def build_firmware(project, proj_path, mode, config_path, artifact_name, jobs=None, output=None):
+    """
+    Build project in proj_path with config_path and return the path of the
+    firmware image. Reuses the build cache when the repo commit, config and
+    toolchain are unchanged, skipping make entirely. Otherwise builds
+    incrementally in a per-mode out-of-tree directory, sending make's output
+    to output(line) if given.
+    """
+    console.print(f"[yellow]Using {project} configuration: {config_path.name}")
+    if not config_path.exists():
+        console.print(f"[red]{project} configuration file {config_path.name} not found in {config_path.parent}.")
+        sys.exit(1)
+
+    key, meta = openams_build.cache_key(project.lower(), proj_path, config_path)
+    cached = openams_build.lookup(key, artifact_name)
+    if cached:
+        console.print(f"[green]Build cache hit for {artifact_name} ({key[:12]}); skipping build.")
+        build_stats.append(openams_build.BuildStats(project, cached=True))
+        return cached
+
+    out_dir, kconfig = openams_build.prepare_build_dir(project.lower(), mode, config_path)
+    jobs = jobs or openams_build.build_jobs()
+    console.print(f"[cyan]Building {project} in {out_dir} ({jobs} jobs)...")
+    # The out dir persists between builds, so a failed build must not leave the previous image behind
+    built = out_dir / artifact_name
+    built.unlink(missing_ok=True)
+    returncode, stats = openams_build.run_make(project, proj_path, out_dir, kconfig, jobs=jobs, output=output)
+    build_stats.append(stats)
+
+    if returncode != 0:
+        console.print(f"[bold red]{project} build failed (make exit {returncode}).")
+        sys.exit(1)
+    if not built.exists():
+        console.print(f"[bold red]{project} build failed. {artifact_name} not found.")
+        sys.exit(1)
+    return openams_build.store(key, meta, built)
+
+def fps_sources():
+    """The Katapult and Klipper trees the FPS images are built from."""
+    return {
+        "Katapult": openams_sources.Source("katapult", KATAPULT_REPO, Path.home() / "katapult", KATAPULT_REF),
+        "Klipper": openams_sources.Source("klipper", KLIPPER_REPO, Path.home() / "klipper", KLIPPER_REF),
+    }
+
+def sync_trees(sources, offline=False, ttl=openams_sources.SYNC_TTL, timeout=openams_sources.SYNC_TIMEOUT):
+    """
+    Sync the named sources ({label: Source}) concurrently: shallow, pinned,
+    from the mirror if configured, skipped when offline or synced within ttl
+    seconds, each given at most timeout seconds. git output is prefixed with
+    the tree name. Prints one status table and exits if a tree is unusable.
+    """
+    from rich.table import Table
+    from rich.text import Text
+
+    labels = {id(source): label for label, source in sources.items()}
+    colors = {id(source): color for source, color in zip(sources.values(), ["green", "magenta", "blue"] * len(sources))}
+
+    def output(source, line):
+        console.print(Text.assemble((f"{source.name:>11} | ", colors[id(source)]), line), highlight=False)
+
+    if not offline:
+        stale = [label for label, source in sources.items() if not openams_sources.is_fresh(source, ttl)]
+        if stale:
+            console.print(f"[cyan]Syncing {', '.join(stale)} ({openams_sources.SYNC_JOBS} at a time, {timeout:g}s limit each)...")
+    results = openams_sources.sync_all(list(sources.values()), output=output, offline=offline, ttl=ttl, timeout=timeout)
+
+    table = Table(title="Source Sync")
+    table.add_column("Tree", style="cyan")
+    table.add_column("Result")
+    table.add_column("Commit", style="magenta")
+    table.add_column("Time", justify="right")
+    table.add_column("Detail")
+    unusable = []
+    for source, result in zip(sources.values(), results):
+        if result.ok:
+            color = "yellow" if result.action == "offline" else "green"
+            if result.action == "fresh":
+                detail = f"synced {(time.time() - openams_sources.last_sync(source)['time']) / 60:.0f} min ago"
+            else:
+                detail = result.origin if result.action not in ("offline", "at pin") else (source.ref or "")
+        else:
+            color = "red"
+            detail = result.error if result.commit else f"{result.error}; no tree to fall back to"
+            if not result.commit:
+                unusable.append(labels[id(source)])
+        table.add_row(labels[id(source)], f"[{color}]{result.action}", result.commit[:12] or "-", f"{result.seconds:.1f}s", detail)
+    console.print(table)
+    if unusable:
+        console.print(f"[red]Cannot continue without {', '.join(unusable)}.")
+        sys.exit(1)
+    return results
+
+def prepare_fps_images(script_dir, mode):
+    """
+    Build both FPS images for mode from ~/katapult and ~/klipper (synced by
+    the caller via sync_trees()), using the .config-* files in script_dir.
+    The two trees are independent, so they are built concurrently, each
+    with half the job slots and its output prefixed with the project name.
+    Returns (katapult_bin, klipper_bin).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from rich.text import Text
+
+    jobs = max(1, openams_build.build_jobs() // 2)
+    sources = fps_sources()
+
+    def build(project, artifact_name, color):
+        def output(line):
+            console.print(Text.assemble((f"{project.lower():>8} | ", color), line), highlight=False)
+        config_path = script_dir / f".config-{project.lower()}-{mode}"
+        return build_firmware(project, sources[project].path, mode, config_path, artifact_name, jobs=jobs, output=output)
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        katapult = pool.submit(build, "Katapult", "katapult.bin", "magenta")
+        klipper = pool.submit(build, "Klipper", "klipper.bin", "blue")
+        # result() re-raises a SystemExit from a failed build in this thread
+        return katapult.result(), klipper.result()
+
+def self_source(script_dir):
+    """{"openams_cli": Source} for this checkout if it is a git clone, else {}."""
+    if not (script_dir / ".git").exists():
+        return {}
+    return {"openams_cli": openams_sources.Source("openams_cli", None, script_dir)}
+
+def print_build_summary():
+    """Print wall time, CPU time and ccache hit rate for the builds of this run."""
+    if not build_stats:
+        return
+    from rich.table import Table
+    table = Table(title="Build Summary")
+    table.add_column("Project", style="cyan")
+    table.add_column("Result")
+    table.add_column("Jobs", justify="right")
+    table.add_column("Wall", justify="right")
+    table.add_column("CPU", justify="right")
+    table.add_column("ccache hits", justify="right")
+    for stats in build_stats:
+        if stats.cached:
+            table.add_row(stats.project, "[green]cached", "-", "-", "-", "-")
+            continue
+        hit_rate = f"{stats.hit_rate:.0%}" if stats.hit_rate is not None else "N/A"
+        table.add_row(stats.project, "built", str(stats.jobs), f"{stats.wall:.1f}s", f"{stats.cpu:.1f}s", hit_rate)
+    console.print(table)
+
+def validate_images(images, config_path=None):
+    """
+    Check [(address, path)] images against the MCU memory map (from
+    config_path when it exists) before any DFU session; exit if any fail.
+    """
+    memory = openams_image.MemoryMap.from_config(config_path) if config_path and config_path.exists() else None
+    try:
+        openams_image.validate(images, memory)
+    except openams_image.ImageError as e:
+        console.print("[bold red]Firmware image validation failed; nothing was flashed:")
+        for problem in str(e).splitlines():
+            console.print(f"[red]  {problem}")
+        sys.exit(1)
+
+def wait_for_dfu_device():
+    """
+    Block until an STM32 in DFU mode (0483:df11) is attached and return it.
+    Other matching devices already attached are listed so the user can tell boards apart.
+    """
+    console.print("[cyan]Waiting for STM32 device in DFU mode...")
+    device = openams_usb.wait_for_device([openams_usb.DFU_ID])
+    console.print(f"[green]Device detected: {device.describe()}")
+    others = [d for d in openams_usb.list_devices([openams_usb.DFU_ID]) if d.path != device.path]
+    if others:
+        console.print(f"[yellow]{len(others)} other DFU device(s) attached; flashing only {device.path}:")
+        for other in others:
+            console.print(f"  [yellow]{other.describe()}")
+    return device
+
+def flash_dfu(dfu_device, segments, skip_identical=True, verify=False):
+    """
+    Flash segments to dfu_device in a single DfuSe session, erasing only the
+    pages they cover and, with skip_identical, leaving segments already in
+    flash alone and rewriting only pages changed since the last flash of
+    this board. With verify, written segments are read back and compared.
+    Falls back to one dfu-util run per segment (mass erase on the first) if
+    pyusb/libusb is missing or the device cannot be opened.
+    """
+    from rich.progress import BarColumn, DownloadColumn, Progress, TextColumn, TransferSpeedColumn
+    try:
+        openams_dfu.import_usb()
+    except ImportError as e:
+        console.print(f"[yellow]Native DFU flasher unavailable ({e}); using dfu-util (no skip or read-back verify).")
+        if not flash_dfu_util(dfu_device, segments):
+            console.print("[bold red]dfu-util flashing failed.")
+            sys.exit(1)
+        return
+    serial = dfu_device.serial if skip_identical else None
+    if not skip_identical:
+        openams_dfu.forget(dfu_device.serial)
+
+    try:
+        with Progress(
+            TextColumn("[progress.description]{task.description}"),
+            BarColumn(),
+            DownloadColumn(),
+            TransferSpeedColumn(),
+        ) as progress:
+            tasks = {id(segment): progress.add_task(f"[cyan]{segment.name} @ 0x{segment.address:08x}", total=len(segment.data))
+                     for segment in segments}
+            stats = openams_dfu.flash(
+                segments, path=dfu_device.path, skip_identical=skip_identical, verify=verify, serial=serial,
+                progress=lambda segment, done: progress.update(tasks[id(segment)], completed=done)
+            )
+    except openams_dfu.VerifyError as e:
+        console.print(f"[bold red]{e}. The board may not boot; flash it again.")
+        sys.exit(1)
+    except Exception as e:
+        # usb.core.USBError (e.g. no permission) or openams_dfu.DfuError
+        console.print(f"[yellow]Native DFU flashing failed ({e}); retrying with dfu-util.")
+        if not flash_dfu_util(dfu_device, segments):
+            console.print("[bold red]dfu-util flashing failed as well. The board may not boot; flash it again.")
+            sys.exit(1)
+        return
+    if stats.skipped:
+        console.print(f"[green]Already up to date, not rewritten: {', '.join(stats.skipped)}")
+    if stats.differential:
+        console.print(f"[green]Differential flash: {stats.pages_unchanged} page(s) unchanged since the last flash of {dfu_device.serial}.")
+    if stats.bytes_written:
+        console.print(
+            f"[green]Wrote {stats.bytes_written} bytes in {stats.seconds:.2f}s "
+            f"({stats.throughput / 1024:.1f} KiB/s, {stats.pages_erased} pages erased, transfer size {stats.transfer_size})"
+        )
+    if stats.bytes_verified:
+        console.print(f"[green]Verified {stats.bytes_verified} bytes by read-back.")
+
+def flash_dfu_util(dfu_device, segments, capture=False):
+    """Flash segments with one dfu-util run each. Returns True if every run succeeded."""
+    import tempfile
+    # The mass erase invalidates the differential flash record for this board
+    openams_dfu.forget(dfu_device.serial)
+    for i, segment in enumerate(segments):
+        target = f"0x{segment.address:08x}" + (":force:mass-erase" if i == 0 else "")
+        with tempfile.NamedTemporaryFile(suffix=".bin") as image:
+            image.write(segment.data)
+            image.flush()
+            result = subprocess.run(
+                ["sudo", "dfu-util", "-p", dfu_device.path, "-a", "0", "-s", target, "-D", image.name],
+                capture_output=capture
+            )
+        if result.returncode != 0:
+            return False
+    return True
+
+def flash_all_attached(segments, jobs, skip_identical=True, verify=False):
+    """
+    Farm mode: flash segments to every attached STM32 DFU device concurrently,
+    with at most jobs boards in flight, then print a per-board summary.
+    skip_identical and verify are passed on to openams_dfu.flash().
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from rich.progress import BarColumn, DownloadColumn, Progress, TextColumn, TransferSpeedColumn
+    from rich.table import Table
+
+    devices = openams_usb.list_devices([openams_usb.DFU_ID])
+    if not devices:
+        devices = [wait_for_dfu_device()]
+    console.print(f"[green]Flashing {len(devices)} board(s), {jobs} at a time:")
+    for device in devices:
+        console.print(f"  [cyan]{device.describe()}")
+
+    try:
+        openams_dfu.import_usb()
+        native = True
+    except ImportError as e:
+        console.print(f"[yellow]Native DFU flasher unavailable ({e}); using dfu-util for each board.")
+        native = False
+
+    total = sum(len(segment.data) for segment in segments)
+    offsets = {id(segment): sum(len(s.data) for s in segments[:i]) for i, segment in enumerate(segments)}
+
+    with Progress(
+        TextColumn("[progress.description]{task.description}"),
+        BarColumn(),
+        DownloadColumn(),
+        TransferSpeedColumn(),
+    ) as progress:
+        def flash_one(device):
+            task = progress.add_task(f"[cyan]{device.path} ({device.serial or 'no serial'})", total=total)
+            start = time.monotonic()
+            if not skip_identical:
+                openams_dfu.forget(device.serial)
+            if native:
+                try:
+                    stats = openams_dfu.flash(
+                        segments, path=device.path, skip_identical=skip_identical, verify=verify,
+                        serial=device.serial if skip_identical else None,
+                        progress=lambda segment, done: progress.update(task, completed=offsets[id(segment)] + done)
+                    )
+                    return device, "ok" if stats.bytes_written else "up to date", stats.seconds, stats.throughput
+                except openams_dfu.VerifyError as e:
+                    progress.console.print(f"[red]{device.path}: {e}")
+                    return device, "verify failed", time.monotonic() - start, 0.0
+                except Exception as e:
+                    progress.console.print(f"[yellow]{device.path}: native flashing failed ({e}); retrying with dfu-util.")
+            ok = flash_dfu_util(device, segments, capture=True)
+            progress.update(task, completed=total if ok else 0)
+            seconds = time.monotonic() - start
+            return device, "ok" if ok else "failed", seconds, total / seconds if ok and seconds else 0.0
+
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(flash_one, devices))
+
+    table = Table(title="Flashing Summary")
+    table.add_column("Port", style="cyan")
+    table.add_column("Serial", style="magenta")
+    table.add_column("Result")
+    table.add_column("Time", justify="right")
+    table.add_column("Throughput", justify="right")
+    for device, result, seconds, throughput in results:
+        color = "red" if result in ("failed", "verify failed") else "green"
+        table.add_row(device.path, device.serial or "N/A", f"[{color}]{result}", f"{seconds:.2f}s", f"{throughput / 1024:.1f} KiB/s")
+    console.print(table)
+
+    failed = [r for r in results if r[1] in ("failed", "verify failed")]
+    if failed:
+        console.print(f"[bold red]{len(failed)} of {len(results)} board(s) failed to flash.")
+        sys.exit(1)
+
 @cli.command()
 @click.option(
     "--board",
@@ -286,16 +676,57 @@ def setup_canbus(non_interactive):
     "--allow-missing-programmer", is_flag=True, default=False,
     help="Allow running even if STM32_Programmer_CLI is not available (skip option byte programming)."
 )
-def deploy(board, mode, allow_missing_programmer):
+@click.option(
+    "--all-attached", is_flag=True, default=False,
+    help="Flash every attached STM32 DFU device concurrently (farm mode)."
+)
+@click.option(
+    "--jobs", type=click.IntRange(min=1), default=4, show_default=True,
+    help="Maximum number of boards flashed at once with --all-attached."
+)
+@click.option(
+    "--skip-identical/--always-write", default=True, show_default=True,
+    help="Read flash back first and skip images the board already holds."
+)
+@click.option(
+    "--verify", is_flag=True, default=False,
+    help="Read every written image back and compare it with the file."
+)
+@click.option(
+    "--offline", is_flag=True, default=False,
+    help="Do not touch the network: skip all git updates and build from the trees as they are."
+)
+@click.option(
+    "--sync-ttl", type=click.FloatRange(min=0), default=openams_sources.SYNC_TTL, show_default=True,
+    help="Skip git updates of trees synced less than this many seconds ago (0 always syncs; env OPENAMS_SYNC_TTL)."
+)
+@click.option(
+    "--sync-timeout", type=click.FloatRange(min=0), default=openams_sources.SYNC_TIMEOUT, show_default=True,
+    help="Give up on a git update after this many seconds (0 waits indefinitely; env OPENAMS_SYNC_TIMEOUT)."
+)
+@click.option(
+    "--from-artifacts", "artifacts", type=click.Path(exists=True, path_type=Path), default=None,
+    help="Flash FPS images from a bundle made by 'release' (directory or .tar.gz) instead of building them."
+)
+def deploy(board, mode, allow_missing_programmer, all_attached, jobs, skip_identical, verify, offline, sync_ttl, sync_timeout, artifacts):
     """Deploy Katapult and Klipper to the STM32G0B1 device."""
+    from rich.prompt import Prompt
     script_dir = Path.cwd()
     console.rule("[bold blue]Starting Deployment")
     os.environ["PATH"] = f"{ENV_DIR}/bin:" + os.environ["PATH"]
 
-    # Ensure the current working directory is up to date if it's a git repo
-    if (script_dir / '.git').exists():
-        console.print('[bold cyan]Updating current directory from git...')
-        subprocess.run(['git', 'pull'], cwd=script_dir)
+    bundle = None
+    if artifacts:
+        if board and board.lower() != "fps":
+            console.print("[red]--from-artifacts only applies to the FPS board; OpenAMS Mainboard firmware already ships prebuilt.")
+            sys.exit(1)
+        board = "fps"
+        try:
+            bundle = openams_release.open_bundle(artifacts)
+        except openams_release.BundleError as e:
+            console.print(f"[red]{e}")
+            sys.exit(1)
+        console.print(f"[green]Using prebuilt firmware bundle {bundle[1]['version']} from {artifacts}; skipping git and make.")
 
     # Board selection menu with visible options
     if not board:
@@ -395,47 +826,24 @@ def deploy(board, mode, allow_missing_programmer):
 
     # FPS logic
     if board == "fps":
-        katapult_path = Path.home() / "katapult"
-        if not katapult_path.exists():
-            console.print("[cyan]Cloning Katapult...")
-            subprocess.run(["git", "clone", KATAPULT_REPO, str(katapult_path)])
-        else:
-            console.print("[cyan]Updating Katapult...")
-            subprocess.run(["git", "-C", str(katapult_path), "pull"])
-
-        os.chdir(katapult_path)
-
         # Use mode from CLI if provided, otherwise prompt
         if not mode:
             mode = Prompt.ask("Configure FPS board for", choices=["bridge", "canbus"], default="bridge")
         else:
             mode = mode.lower()
 
-        # Clean up old config files and run make clean before building
-        for proj_path in [katapult_path, Path.home() / "klipper"]:
-            for fname in [".config", ".config.old"]:
-                f = proj_path / fname
-                if f.exists():
-                    f.unlink()
-            # Run make clean if Makefile exists
-            if (proj_path / "Makefile").exists():
-                subprocess.run(["make", "clean"], cwd=proj_path)
-
-        # Katapult config selection
-        katapult_config_file = f".config-katapult-{mode}"
-        console.print(f"[yellow]Using Katapult configuration: {katapult_config_file}")
-        if not (script_dir / katapult_config_file).exists():
-            console.print(f"[red]Katapult configuration file {katapult_config_file} not found in {script_dir}.")
-            sys.exit(1)
-        subprocess.run(["cp", str(script_dir / katapult_config_file), ".config"])
-
-        console.print("[cyan]Building Katapult...")
-        subprocess.run(["make"])
-
-        bin_path = katapult_path / "out" / "katapult.bin"
-        if not bin_path.exists():
-            console.print("[bold red]Build failed. katapult.bin not found.")
-            sys.exit(1)
+        if bundle:
+            try:
+                fps_images = openams_release.images_for(*bundle, mode)
+            except openams_release.BundleError as e:
+                console.print(f"[red]{e}")
+                sys.exit(1)
+        else:
+            # Self-update this checkout and sync Katapult and Klipper in one concurrent pass
+            sources = dict(self_source(script_dir), **fps_sources())
+            sync_trees(sources, offline=offline, ttl=sync_ttl, timeout=sync_timeout)
+            fps_images = list(zip(openams_release.FPS_ADDRESSES.values(), prepare_fps_images(script_dir, mode)))
+        validate_images(fps_images, script_dir / f".config-klipper-{mode}")
 
         console.print("[bold magenta]Please plug in your STM32 device (DFU mode)...")
         
@@ -498,126 +906,281 @@ def deploy(board, mode, allow_missing_programmer):
 
         ensure_device_attached()
 
-        # Wait for STM32 device in DFU mode
-        while True:
-            result = subprocess.run(["sudo", "dfu-util", "-l"], capture_output=True, text=True)
-            if "Found DFU: [0483:df11]" in result.stdout:
-                break
-            time.sleep(1)
-
-        # Optionally, print the found DFU devices for user clarity
-        console.print("[green]Device detected. DFU devices found:")
-        console.print(result.stdout)
-        console.print("[green]Flashing Katapult with mass erase...")
-        subprocess.run(["sudo", "dfu-util", "-a", "0", "-s", "0x08000000:force:mass-erase", "-D", str(bin_path)])
-
-        klipper_path = Path.home() / "klipper"
-        if not klipper_path.exists():
-            console.print("[cyan]Cloning Klipper...")
-            subprocess.run(["git", "clone", KLIPPER_REPO, str(klipper_path)])
+        segments = [openams_dfu.Segment.from_file(address, path) for address, path in fps_images]
+        if all_attached:
+            flash_all_attached(segments, jobs, skip_identical, verify)
         else:
-            console.print("[cyan]Updating Klipper...")
-            subprocess.run(["git", "-C", str(klipper_path), "pull"])
-
-        os.chdir(klipper_path)
-
-        # Klipper config selection
-        klipper_config_file = f".config-klipper-{mode}"
-        console.print(f"[yellow]Using Klipper configuration: {klipper_config_file}")
-        if not (script_dir / klipper_config_file).exists():
-            console.print(f"[red]Klipper configuration file {klipper_config_file} not found in {script_dir}.")
-            sys.exit(1)
-        subprocess.run(["cp", str(script_dir / klipper_config_file), ".config"])
-        console.print("[cyan]Building Klipper...")
-        subprocess.run(["make"])
-
-        klipper_bin = klipper_path / "out" / "klipper.bin"
-        if not klipper_bin.exists():
-            console.print("[bold red]Klipper build failed. klipper.bin not found.")
-            sys.exit(1)
-
-        console.print("[bold magenta]Flashing Klipper to offset 8KiB (0x08002000)...")
-        subprocess.run(["sudo", "dfu-util", "-a", "0", "-s", "0x08002000", "-D", str(klipper_bin)])
+            # Wait for STM32 device in DFU mode
+            dfu_device = wait_for_dfu_device()
+            console.print("[green]Flashing Katapult (0x08000000) and Klipper (offset 8KiB, 0x08002000)...")
+            flash_dfu(dfu_device, segments, skip_identical, verify)
 
+        print_build_summary()
         console.print("[bold green]Deployment complete. Verify operation on your FPS board.")
         return
 
     # OpenAMS Mainboard logic
     if board == "openams":
-        import re
+        if self_source(script_dir):
+            sync_trees(self_source(script_dir), offline=offline, ttl=sync_ttl, timeout=sync_timeout)
         fw_dir = script_dir / "firmwares" / "openams"
-        def find_latest_bin(prefix):
-            bins = list(fw_dir.glob(f"{prefix}_*.bin"))
-            def version_tuple(f):
-                m = re.search(rf'{prefix}_(\d+)\.(\d+)\.(\d+)\.bin', f.name)
-                return tuple(map(int, m.groups())) if m else (0, 0, 0)
-            bins = [f for f in bins if version_tuple(f) != (0, 0, 0)]
-            if not bins:
-                return None
-            return max(bins, key=version_tuple)
-        kancan_bin = find_latest_bin("kancan")
-        oams_bin = find_latest_bin("oams")
-        if not kancan_bin or not oams_bin:
-            console.print(f"[red]Could not find both kancan_*.bin and oams_*.bin in {fw_dir}")
+        try:
+            kancan, oams = openams_firmware.select(openams_firmware.load_index(fw_dir))
+            kancan_bin = openams_firmware.verify(fw_dir, kancan)
+            oams_bin = openams_firmware.verify(fw_dir, oams)
+        except openams_firmware.FirmwareError as e:
+            console.print(f"[red]{e}")
             sys.exit(1)
-        console.print(f"[yellow]Flashing {kancan_bin.name} to 0x08000000 and {oams_bin.name} to 0x08002000")
+        validate_images([(int(kancan["address"], 16), kancan_bin), (int(oams["address"], 16), oams_bin)])
+        console.print(f"[yellow]Flashing {kancan_bin.name} to {kancan['address']} and {oams_bin.name} to {oams['address']}")
 
         ensure_device_attached()
 
-        # Wait for STM32 device in DFU mode
-        while True:
-            result = subprocess.run(["sudo", "dfu-util", "-l"], capture_output=True, text=True)
-            if "Found DFU: [0483:df11]" in result.stdout:
-                break
-            time.sleep(1)
-        console.print("[green]Device detected. DFU devices found:")
-        console.print(result.stdout)
-        console.print("[green]Flashing OpenAMS Mainboard firmware...")
-        subprocess.run(["sudo", "dfu-util", "-a", "0", "-s", "0x08000000:force:mass-erase", "-D", str(kancan_bin)])
-        subprocess.run(["sudo", "dfu-util", "-a", "0", "-s", "0x08002000", "-D", str(oams_bin)])
+        segments = [
+            openams_dfu.Segment.from_file(int(kancan["address"], 16), kancan_bin),
+            openams_dfu.Segment.from_file(int(oams["address"], 16), oams_bin),
+        ]
+        if all_attached:
+            flash_all_attached(segments, jobs, skip_identical, verify)
+        else:
+            # Wait for STM32 device in DFU mode
+            dfu_device = wait_for_dfu_device()
+            console.print("[green]Flashing OpenAMS Mainboard firmware...")
+            flash_dfu(dfu_device, segments, skip_identical, verify)
         console.print("[bold green]Deployment complete. Verify operation on your OpenAMS Mainboard.")
         return
 
 @cli.command()
-def query():
+@click.option(
+    "--mode",
+    type=click.Choice(["bridge", "canbus"], case_sensitive=False), default="bridge", show_default=True,
+    help="FPS board mode to build firmware for."
+)
+@click.option("--offline", is_flag=True, default=False, help="Do not touch the network; build the trees as they are.")
+@click.option(
+    "--sync-ttl", type=click.FloatRange(min=0), default=openams_sources.SYNC_TTL, show_default=True,
+    help="Skip git updates of trees synced less than this many seconds ago (0 always syncs)."
+)
+@click.option(
+    "--sync-timeout", type=click.FloatRange(min=0), default=openams_sources.SYNC_TIMEOUT, show_default=True,
+    help="Give up on a git update after this many seconds (0 waits indefinitely)."
+)
+def build(mode, offline, sync_ttl, sync_timeout):
+    """Build the FPS Katapult and Klipper images into the build cache without flashing."""
+    console.rule("[bold blue]Building FPS Firmware")
+    os.environ["PATH"] = f"{ENV_DIR}/bin:" + os.environ["PATH"]
+    sync_trees(fps_sources(), offline=offline, ttl=sync_ttl, timeout=sync_timeout)
+    prepare_fps_images(Path.cwd(), mode.lower())
+    print_build_summary()
+    console.print("[bold green]Build complete. A following deploy for this mode will reuse the cached images.")
+
+@cli.command()
+@click.option(
+    "--version", "version", default=None,
+    help="Bundle version (default: 'git describe' of this checkout)."
+)
+@click.option(
+    "--output", type=click.Path(file_okay=False, path_type=Path), default=Path("dist"), show_default=True,
+    help="Directory to write the bundle into."
+)
+@click.option("--tarball", is_flag=True, default=False, help="Also pack the bundle into a .tar.gz.")
+def release(version, output, tarball):
+    """Build every FPS firmware variant into a versioned bundle for 'deploy --from-artifacts'."""
+    script_dir = Path.cwd()
+    console.rule("[bold blue]Building FPS Release Bundle")
+    os.environ["PATH"] = f"{ENV_DIR}/bin:" + os.environ["PATH"]
+    if not version:
+        result = subprocess.run(["git", "describe", "--tags", "--always", "--dirty"], cwd=script_dir, capture_output=True, text=True)
+        version = result.stdout.strip() or time.strftime("%Y%m%d%H%M%S")
+
+    sync_trees(fps_sources())
+    images = []
+    for mode in openams_release.MODES:
+        console.print(f"[bold cyan]Building {mode} images...")
+        artifacts = prepare_fps_images(script_dir, mode)
+        validate_images(list(zip(openams_release.FPS_ADDRESSES.values(), artifacts)), script_dir / f".config-klipper-{mode}")
+        for project, artifact in zip(openams_release.FPS_ADDRESSES, artifacts):
+            meta = openams_build.read_meta(artifact)
+            images.append({
+                "project": project, "mode": mode, "path": artifact,
+                "commit": meta.get("commit", ""), "config_sha256": meta.get("config_sha256", ""),
+            })
+    print_build_summary()
+
+    bundle_dir = openams_release.write_bundle(output, version, images, toolchain=openams_build.toolchain_version())
+    console.print(f"[bold green]Bundle {version} written to {bundle_dir}")
+    if tarball:
+        console.print(f"[bold green]Packed {openams_release.make_tarball(bundle_dir)}")
+    console.print("[cyan]Flash it on a printer with: openams_cli.py deploy --from-artifacts <bundle> --mode <bridge|canbus>")
+
+@cli.command()
+def firmware_index():
+    """Refresh sizes and SHA-256 hashes in firmwares/openams/index.json."""
+    fw_dir = Path.cwd() / "firmwares" / "openams"
+    try:
+        unindexed = openams_firmware.refresh(fw_dir)
+    except openams_firmware.FirmwareError as e:
+        console.print(f"[red]{e}")
+        sys.exit(1)
+    console.print(f"[green]Updated {fw_dir / openams_firmware.INDEX_FILE}")
+    for name in unindexed:
+        console.print(f"[yellow]{name} is not in the index; add its name, version, address and compatible bootloaders by hand.")
+
+@cli.command()
+@click.option("--interface", default=openams_can.DEFAULT_INTERFACE, show_default=True, help="CAN interface to query.")
+@click.option("--timeout", type=float, default=openams_can.DEFAULT_TIMEOUT, show_default=True, help="Deadline in seconds to listen for replies.")
+@click.option("--expect", type=click.IntRange(min=1), default=None, help="Stop as soon as this many distinct UUIDs have answered.")
+@click.option(
+    "--format", "output_format",
+    type=click.Choice(["text", "json", "ndjson"], case_sensitive=False), default="text", show_default=True,
+    help="Output format. json/ndjson emit one record per node for scripts."
+)
+@click.option("--watch", is_flag=True, default=False, help="Keep querying and stream node_added/node_removed events.")
+@click.option("--duration", type=float, default=None, help="With --watch, stop after this many seconds (default: run until interrupted).")
+def query(interface, timeout, expect, output_format, watch, duration):
     """Query the CANBus network for Klipper devices and display UUIDs."""
+    output_format = output_format.lower()
+    if watch:
+        watch_nodes(interface, expect, duration, output_format)
+        return
+    if output_format != "text":
+        # Machine-readable output: plain stdout, errors on stderr, no rich rendering
+        try:
+            nodes = openams_can.discover(interface, timeout=timeout, expect=expect)
+        except OSError as e:
+            click.echo(f"CANBus query failed on {interface}: {e}", err=True)
+            sys.exit(1)
+        records = [dataclasses.asdict(node) for node in nodes]
+        if output_format == "json":
+            click.echo(json.dumps(records))
+        else:
+            for record in records:
+                click.echo(json.dumps(record))
+        return
+
     console.rule("[bold blue]Querying CANBus Network")
 
-    # Ensure 'can' pip package is installed in the venv
-    pip = ENV_DIR / "bin" / "pip"
-    result = subprocess.run([str(pip), "show", "python-can"], capture_output=True, text=True)
-    if result.returncode != 0:
-        console.print("[yellow]python-can package not found. Installing...")
-        subprocess.run([str(pip), "install", "python-can"])
-
-    # Run the canbus_query script
-    canbus_query_script = Path.home() / "klipper" / "scripts" / "canbus_query.py"
-    if not canbus_query_script.exists():
-        console.print(f"[red]canbus_query.py script not found at {canbus_query_script}")
+    console.print(f"[cyan]Querying unassigned nodes on {interface}...")
+    try:
+        nodes = openams_can.discover(interface, timeout=timeout, expect=expect)
+    except OSError as e:
+        console.print(f"[red]CANBus query failed on {interface}: {e}")
         sys.exit(1)
 
-    console.print(f"[cyan]Running: {canbus_query_script} can0")
-    result = subprocess.run([str(VENV_PYTHON), str(canbus_query_script), "can0"], capture_output=True, text=True)
-    if result.returncode == 0:
-        console.print("[green]CANBus query result:")
-        console.print(result.stdout)
-        import re
-        uuids = re.findall(r'canbus_uuid=([0-9a-fA-F]+)', result.stdout)
-        if uuids:
-            console.print(f"[bold green]Found {len(uuids)} UUID(s):")
-            for i, uuid in enumerate(uuids, 1):
-                console.print(f"  [cyan]{i}: {uuid}[/cyan]")
-        else:
-            console.print("[yellow]No UUIDs found in CANBus query output.")
+    if nodes:
+        console.print(f"[bold green]Found {len(nodes)} UUID(s):")
+        for i, node in enumerate(nodes, 1):
+            console.print(f"  [cyan]{i}: canbus_uuid={node.uuid}, Application: {node.application} ({node.latency * 1000:.1f} ms)[/cyan]")
     else:
-        console.print(f"[red]CANBus query failed:\n{result.stderr}")
+        console.print("[yellow]No UUIDs found on the CANBus.")
+    if expect is not None and len(nodes) < expect:
+        console.print(f"[yellow]Expected {expect} UUID(s) but only {len(nodes)} answered within {timeout}s.")
+
+def watch_nodes(interface, expect, duration, output_format):
+    """
+    Stream node arrival/departure events for query --watch. Events are NDJSON
+    unless the text format was requested. With expect, exit once that many
+    nodes are present at the same time.
+    """
+    if output_format == "text":
+        console.rule(f"[bold blue]Watching CANBus Network ({interface})")
+    present = set()
+    try:
+        for event, node in openams_can.watch(interface, duration=duration):
+            if event == "node_added":
+                present.add(node.uuid)
+            else:
+                present.discard(node.uuid)
+            if output_format == "text":
+                color = "green" if event == "node_added" else "yellow"
+                console.print(f"[{color}]{event}: canbus_uuid={node.uuid}, Application: {node.application}")
+            else:
+                click.echo(json.dumps(dict(event=event, time=time.time(), **dataclasses.asdict(node))))
+            if expect is not None and len(present) >= expect:
+                return
+    except OSError as e:
+        if output_format == "text":
+            console.print(f"[red]CANBus watch failed on {interface}: {e}")
+        else:
+            click.echo(f"CANBus watch failed on {interface}: {e}", err=True)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        pass
+
+@cli.command()
+@click.argument("mirror_dir", type=click.Path(file_okay=False, path_type=Path))
+@click.option("--bundle", is_flag=True, default=False, help="Also write <name>.bundle files for copying to machines without network.")
+def mirror(mirror_dir, bundle):
+    """Create or refresh local bare mirrors of Katapult and Klipper for OPENAMS_GIT_MIRROR."""
+    for project, source in fps_sources().items():
+        console.print(f"[cyan]Mirroring {project} into {mirror_dir}...")
+        try:
+            openams_sources.update_mirror(source, mirror_dir, bundle=bundle)
+        except openams_sources.SyncError as e:
+            console.print(f"[red]{e}")
+            sys.exit(1)
+    console.print(f"[bold green]Mirrors ready. On each printer: export OPENAMS_GIT_MIRROR={mirror_dir.resolve()}")
+
+@cli.command("bundle-deps")
+@click.option("--output", "wheelhouse", type=click.Path(file_okay=False, path_type=Path), default=openams_deps.WHEELHOUSE,
+              show_default=True, help="Wheelhouse directory to write.")
+@click.option("--python-version", default=None, help="Python version of the target machines, e.g. 3.11 (default: the venv's).")
+def bundle_deps(wheelhouse, python_version):
+    """Download wheels of all Python dependencies for offline installs with --no-index."""
+    console.print(f"[cyan]Downloading wheels for {openams_deps.REQUIREMENTS_PATH.name} into {wheelhouse}...")
+    try:
+        lock = openams_deps.build_wheelhouse(wheelhouse, python_version=python_version)
+    except subprocess.CalledProcessError as e:
+        console.print(f"[red]pip download failed (exit {e.returncode})")
+        sys.exit(1)
+    count = len(lock.read_text().splitlines())
+    console.print(f"[bold green]{count} wheels locked in {lock}.")
+    if wheelhouse.resolve() != openams_deps.WHEELHOUSE.resolve():
+        console.print(f"[green]Copy it next to openams_cli.py as wheelhouse/ or set OPENAMS_WHEELHOUSE={wheelhouse.resolve()}")
+
+@cli.group()
+def cache():
+    """Inspect and prune the firmware build cache."""
+
+@cache.command("ls")
+def cache_ls():
+    """List cached firmware builds, most recently used first."""
+    from rich.table import Table
+    entries = openams_build.entries()
+    if not entries:
+        console.print(f"[yellow]Build cache at {openams_build.CACHE_DIR} is empty.")
+        return
+    table = Table(title=f"Build Cache ({openams_build.CACHE_DIR})")
+    table.add_column("Key", style="cyan")
+    table.add_column("Project")
+    table.add_column("Commit", style="magenta")
+    table.add_column("Config")
+    table.add_column("Size", justify="right")
+    table.add_column("Last used")
+    for entry in entries:
+        table.add_row(
+            entry["key"][:12], entry.get("project", "?"), entry.get("commit", "?")[:12],
+            entry.get("config", "?"), f"{entry['size'] / 1024:.1f} KiB", time.ctime(entry["last_used"])
+        )
+    console.print(table)
+    console.print(f"[green]{len(entries)} entries, {sum(e['size'] for e in entries) / 1024:.1f} KiB total.")
+
+@cache.command("gc")
+@click.option(
+    "--max-size", type=click.IntRange(min=0), default=openams_build.MAX_CACHE_BYTES // (1024 * 1024), show_default=True,
+    help="Evict least recently used builds until the cache fits in this many MiB (0 empties it)."
+)
+def cache_gc(max_size):
+    """Evict least recently used firmware builds."""
+    evicted = openams_build.gc(max_size * 1024 * 1024)
+    console.print(f"[green]Evicted {len(evicted)} cached build(s), freed {sum(e['size'] for e in evicted) / 1024:.1f} KiB.")
 
 @cli.command()
 def setup_klipper_config():
     """Set up Klipper configuration (oams.cfg and macros) using CANBus UUIDs."""
     import re
     import requests
-    from rich.prompt import IntPrompt
+    from rich.prompt import Confirm, IntPrompt, Prompt
 
     # Ask user to enter the UUIDs found (from query)
     console.print("[bold blue]Klipper Configuration Setup")
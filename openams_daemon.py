@@ -1,19 +1,37 @@
+import asyncio
 import time
 from pathlib import Path
 from rich.console import Console
-from rich.progress import Progress, SpinnerColumn, TextColumn, TimeElapsedColumn
 import sys
 import json
+import socket
 import subprocess
-import re
 import os
+import urllib.request
 
 VENV_PYTHON = str(Path.home() / ".openams_env" / "bin" / "python")
-OPENAMS_CLI = str(Path(__file__).parent / "openams_cli.py")
+# The daemon is installed to /usr/local/bin; OPENAMS_HOME points back at the checkout
+OPENAMS_HOME = Path(os.environ.get("OPENAMS_HOME", Path(__file__).parent))
+OPENAMS_CLI = str(OPENAMS_HOME / "openams_cli.py")
+sys.path.insert(0, str(OPENAMS_HOME))
+
+import openams_netlink
 
 LOG_PATH = "/var/log/openams_assistant.log"
 STATE_PATH = "/var/lib/openams_assistant/state.json"
+# Seconds to wait for both boards; 0 waits indefinitely (device-activated unit)
+DISCOVERY_TIMEOUT = float(os.environ.get("OPENAMS_DISCOVERY_TIMEOUT", 900))
+
+# Templates setup_klipper_config reuses when already present in /tmp
+KLIPPER_OPENAMS_REPO = "https://raw.githubusercontent.com/OpenAMSOrg/klipper_openams/master/"
+KLIPPER_TEMPLATES = {
+    "oams_sample.cfg": Path("/tmp/oams_sample.cfg"),
+    "oams_macros.cfg": Path("/tmp/oams_macros.cfg"),
+}
+KLIPPER_CONFIG_DIR = Path.home() / "printer_data" / "config"
+
 console = Console()
+phase_times = {}
 
 def log(msg):
     try:
@@ -38,27 +56,130 @@ def save_state(state):
     with open(STATE_PATH, "w") as f:
         json.dump(state, f)
 
-def query_uuid():
-    result = subprocess.run(
-        [VENV_PYTHON, OPENAMS_CLI, "query"],
-        capture_output=True, text=True
-    )
-    uuids = re.findall(r'canbus_uuid=([0-9a-fA-F]+)', result.stdout)
-    return uuids
+def sd_notify(*messages):
+    """
+    Send a state update to systemd (Type=notify). A no-op when not running
+    under systemd or when NOTIFY_SOCKET is not set.
+    """
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address.startswith("@"):
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.sendto("\n".join(messages).encode(), address)
+    except OSError as e:
+        log(f"sd_notify failed: {e}")
+
+async def watchdog():
+    """Ping the systemd watchdog at half the configured WatchdogSec."""
+    usec = os.environ.get("WATCHDOG_USEC")
+    if not usec:
+        return
+    interval = int(usec) / 1e6 / 2
+    while True:
+        sd_notify("WATCHDOG=1")
+        await asyncio.sleep(interval)
 
-def run_and_log(cmd, **kwargs):
+async def timed(name, coro):
+    """Await coro, recording its wall time under name in phase_times."""
+    sd_notify(f"STATUS=Running phase: {name}")
+    start = time.monotonic()
+    try:
+        return await coro
+    finally:
+        phase_times[name] = time.monotonic() - start
+        log(f"Phase {name} took {phase_times[name]:.2f}s")
+
+async def run_and_log(*cmd):
     # Stream output to console and log file
     log(f"Running: {' '.join(cmd)}")
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, **kwargs)
-    for line in process.stdout:
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    async for line in process.stdout:
+        line = line.decode(errors="replace")
         print(line, end='')
         log(line.rstrip())
-    process.wait()
-    return process.returncode
+    return await process.wait()
+
+async def watch_uuids(fps_uuid, duration):
+    """
+    Run a single `query --watch` and return the mainboard UUID as soon as the
+    FPS and one other node are on the bus, or None if the watcher exits first.
+    A duration of None watches until the boards appear.
+    """
+    cmd = [VENV_PYTHON, OPENAMS_CLI, "query", "--watch", "--format", "ndjson", "--expect", "2"]
+    if duration is not None:
+        cmd += ["--duration", str(duration)]
+    process = await asyncio.create_subprocess_exec(
+        *cmd, stdout=subprocess.PIPE, cwd=str(OPENAMS_HOME)
+    )
+    present = set()
+    try:
+        async for line in process.stdout:
+            if not line.startswith(b"{"):
+                continue
+            event = json.loads(line)
+            if event["event"] == "node_added":
+                present.add(event["uuid"])
+            else:
+                present.discard(event["uuid"])
+            if fps_uuid in present and len(present) > 1:
+                return [u for u in present if u != fps_uuid][0]
+        return None
+    finally:
+        if process.returncode is None:
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                pass
+        await process.wait()
+
+async def discover_mainboard(state):
+    console.print("[cyan]Waiting for both FPS and Mainboard UUIDs to appear on CANBus...")
+    deadline = time.monotonic() + DISCOVERY_TIMEOUT if DISCOVERY_TIMEOUT else None
+    while True:
+        remaining = deadline - time.monotonic() if deadline is not None else None
+        if remaining is not None and remaining <= 0:
+            return None
+        # One long-lived watcher; it only exits early if can0 is not up yet
+        mainboard_uuid = await watch_uuids(state.get("fps_uuid"), remaining)
+        if mainboard_uuid:
+            return mainboard_uuid
+        # Wait for the kernel to report can0 up rather than polling it
+        loop = asyncio.get_running_loop()
+        link = await loop.run_in_executor(None, openams_netlink.wait_for_link, "can0", True, 5)
+        if link is None:
+            log("Waiting for can0 to come up...")
+        else:
+            # can0 is up but the expected boards were not both seen; back off
+            await asyncio.sleep(2)
+
+def fetch_templates():
+    for name, path in KLIPPER_TEMPLATES.items():
+        if path.exists():
+            continue
+        with urllib.request.urlopen(KLIPPER_OPENAMS_REPO + name, timeout=30) as response:
+            path.write_bytes(response.read())
+
+async def prepare_klipper():
+    """
+    Get everything config generation needs ready while CAN discovery runs:
+    the Klipper config directory and the OpenAMS config templates.
+    """
+    KLIPPER_CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, fetch_templates)
+    except OSError as e:
+        # setup_klipper_config retries the download itself
+        console.print(f"[yellow]Could not prefetch Klipper config templates: {e}")
+        log(f"Template prefetch failed: {e}")
 
-def start_klipper():
-    run_and_log(["sudo", "systemctl", "enable", "klipper"])
-    run_and_log(["sudo", "systemctl", "start", "klipper"])
+async def start_klipper():
+    await run_and_log("sudo", "systemctl", "enable", "klipper")
+    await run_and_log("sudo", "systemctl", "start", "klipper")
     log("Klipper enabled and started.")
 
 def print_summary(state):
@@ -69,6 +190,8 @@ def print_summary(state):
     console.print("[bold green]OpenAMS Setup Summary")
     for comp, uuid in table:
         console.print(f"[cyan]{comp}: [magenta]{uuid}")
+    for phase, seconds in phase_times.items():
+        console.print(f"[cyan]{phase}: [magenta]{seconds:.2f}s")
     console.print(f"[bold blue]Log file: {LOG_PATH}")
 
 def uninstall_self():
@@ -76,6 +199,7 @@ def uninstall_self():
     Disables and removes the openams-daemon systemd service and deletes the daemon script.
     """
     service_path = "/etc/systemd/system/openams-daemon.service"
+    udev_rule_path = "/etc/udev/rules.d/90-openams-daemon.rules"
     daemon_path = "/usr/local/bin/openams-daemon"
     try:
         console.print("[yellow]Uninstalling openams-daemon systemd service...")
@@ -83,7 +207,7 @@ def uninstall_self():
         # Disable and stop the service
         subprocess.run(["sudo", "systemctl", "disable", "--now", "openams-daemon.service"], check=False)
         # Remove the service file
-        subprocess.run(["sudo", "rm", "-f", service_path], check=False)
+        subprocess.run(["sudo", "rm", "-f", service_path, udev_rule_path], check=False)
         # Remove the daemon script
         subprocess.run(["sudo", "rm", "-f", daemon_path], check=False)
         # Reload systemd
@@ -94,56 +218,57 @@ def uninstall_self():
         console.print(f"[red]Failed to uninstall openams-daemon: {e}")
         log(f"Failed to uninstall openams-daemon: {e}")
 
-def main():
+async def run():
     state = load_state()
     console.rule("[bold blue]OpenAMS Daemon: Waiting for Both UUIDs")
-    console.print("[cyan]Waiting for both FPS and Mainboard UUIDs to appear on CANBus...")
+    watchdog_task = asyncio.create_task(watchdog())
+    # Report started now so systemd enforces the watchdog over the discovery
+    # and config phases; progress from here on is reported through STATUS=
+    sd_notify("READY=1", "STATUS=Waiting for CANBus UUIDs")
+    start = time.monotonic()
+    try:
+        # CAN discovery and Klipper preparation are independent; run them together
+        mainboard_uuid, _ = await asyncio.gather(
+            timed("can_discovery", discover_mainboard(state)),
+            timed("klipper_prepare", prepare_klipper()),
+        )
+        if not mainboard_uuid:
+            console.print(f"[red]Timeout: Could not detect both UUIDs on CANBus after {DISCOVERY_TIMEOUT:g} seconds.")
+            log("Timeout waiting for both UUIDs on CANBus.")
+            sd_notify("STATUS=Timed out waiting for CANBus UUIDs")
+            return 1
+        state["mainboard_uuid"] = mainboard_uuid
+        save_state(state)
+        console.print(f"[green]Mainboard UUID detected: {mainboard_uuid}")
+        log(f"Mainboard UUID: {mainboard_uuid}")
+
+        # Setup macros and config
+        console.rule("[bold blue]Klipper Configuration")
+        console.print("[cyan]Setting up Klipper macros and config...")
+        await timed("klipper_config", run_and_log(VENV_PYTHON, OPENAMS_CLI, "setup_klipper_config"))
 
-    timeout = 900  # seconds (15 minutes)
-    start_time = time.time()
-    with Progress(
-        SpinnerColumn(),
-        TextColumn("[progress.description]{task.description}"),
-        TimeElapsedColumn(),
-        transient=True
-    ) as progress:
-        task = progress.add_task("[cyan]Scanning CANBus for both UUIDs...", start=True)
-        while True:
-            uuids = query_uuid()
-            if state.get("fps_uuid") in uuids and len(uuids) > 1:
-                mainboard_uuid = [u for u in uuids if u != state["fps_uuid"]][0]
-                state["mainboard_uuid"] = mainboard_uuid
-                save_state(state)
-                console.print(f"[green]Mainboard UUID detected: {mainboard_uuid}")
-                log(f"Mainboard UUID: {mainboard_uuid}")
-                break
-            elapsed = time.time() - start_time
-            progress.update(task, description=f"[cyan]Scanning CANBus for both UUIDs... ({int(elapsed)}s elapsed)")
-            if elapsed > timeout:
-                console.print("[red]Timeout: Could not detect both UUIDs on CANBus after 900 seconds.")
-                log("Timeout waiting for both UUIDs on CANBus.")
-                sys.exit(1)
-            time.sleep(2)
-
-    # 14. Setup macros and config
-    console.rule("[bold blue]Klipper Configuration")
-    console.print("[cyan]Setting up Klipper macros and config...")
-    run_and_log([
-        VENV_PYTHON, OPENAMS_CLI, "setup_klipper_config"
-    ])
-
-    # 15. Re-enable and restart Klipper
-    console.rule("[bold blue]Restarting Klipper")
-    console.print("[cyan]Re-enabling and restarting Klipper...")
-    start_klipper()
-
-    # 16. Print summary and exit
+        # Re-enable and restart Klipper
+        console.rule("[bold blue]Restarting Klipper")
+        console.print("[cyan]Re-enabling and restarting Klipper...")
+        await timed("klipper_start", start_klipper())
+    finally:
+        watchdog_task.cancel()
+
+    phase_times["total"] = time.monotonic() - start
+    sd_notify(f"STATUS=Printer ready in {phase_times['total']:.1f}s")
+
+    # Print summary and exit
     console.rule("[bold green]OpenAMS Setup Complete")
     print_summary(state)
     log("OpenAMS Assistant completed successfully.")
+    return 0
 
+def main():
+    result = asyncio.run(run())
+    if result:
+        sys.exit(result)
     # Uninstall self
     uninstall_self()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,180 @@
+"""
+Python dependencies of the ~/.openams_env virtualenv.
+
+requirements.txt lists what the tools need at run time. A stamp file in the
+venv records the hash of that list plus the venv's interpreter, so the
+normal check is one small file read. Only when the stamp is stale are the
+installed distributions inspected with importlib.metadata, and everything
+missing is installed in a single pip run. Standard library only, so the
+bootstrap can use it before the venv exists.
+
+For machines without PyPI access, `bundle-deps` downloads pure-Python
+wheels of every requirement (and their dependencies) into a wheelhouse
+with a hash-pinned requirements.lock. When a wheelhouse is present, pip
+installs from it with --no-index --require-hashes. The lock's hash is part
+of the stamp, so repeating the bootstrap with the same wheelhouse is a no-op.
+"""
+import hashlib
+import importlib.metadata
+import os
+import re
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ENV_DIR = Path.home() / ".openams_env"
+REQUIREMENTS_PATH = Path(__file__).parent / "requirements.txt"
+STAMP_NAME = ".openams-deps.stamp"
+WHEELHOUSE = Path(os.environ.get("OPENAMS_WHEELHOUSE", Path(__file__).parent / "wheelhouse"))
+LOCK_NAME = "requirements.lock"
+
+
+class DepsError(Exception):
+    """Raised when the venv still lacks requirements after installing them."""
+
+
+def requirements(path=REQUIREMENTS_PATH):
+    """Return the requirement lines of path, without comments or blanks."""
+    lines = []
+    for line in Path(path).read_text().splitlines():
+        line = line.split("#", 1)[0].strip()
+        if line:
+            lines.append(line)
+    return lines
+
+
+def _normalize(name):
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def _version_tuple(version):
+    return tuple(int(part) for part in re.findall(r"\d+", version)[:4])
+
+
+def site_packages(env_dir=ENV_DIR):
+    """The venv's site-packages directory, or None if the venv has none yet."""
+    return next(iter(sorted(Path(env_dir).glob("lib/python*/site-packages"))), None)
+
+
+def wheelhouse_lock(wheelhouse=WHEELHOUSE):
+    """The wheelhouse's requirements.lock, or None if there is no usable wheelhouse."""
+    lock = Path(wheelhouse) / LOCK_NAME if wheelhouse else None
+    return lock if lock and lock.is_file() else None
+
+
+def stamp_digest(env_dir=ENV_DIR, path=REQUIREMENTS_PATH, lock=None):
+    """
+    Hash of the requirements, the interpreter the venv runs (which changes
+    on a Python upgrade) and the wheelhouse lock, if one is used.
+    """
+    interpreter = (Path(env_dir) / "bin" / "python").resolve()
+    data = Path(path).read_bytes() + b"\0" + str(interpreter).encode()
+    if lock:
+        data += b"\0" + Path(lock).read_bytes()
+    return hashlib.sha256(data).hexdigest()
+
+
+def missing(env_dir=ENV_DIR, path=REQUIREMENTS_PATH):
+    """Return the requirement lines not satisfied by the venv's installed distributions."""
+    site = site_packages(env_dir)
+    installed = {}
+    if site:
+        for dist in importlib.metadata.distributions(path=[str(site)]):
+            installed[_normalize(dist.metadata["Name"] or "")] = dist.version
+    result = []
+    for requirement in requirements(path):
+        match = re.match(r"([A-Za-z0-9_.-]+)\s*(>=\s*([\w.]+))?", requirement)
+        version = installed.get(_normalize(match.group(1)))
+        if version is None or match.group(3) and _version_tuple(version) < _version_tuple(match.group(3)):
+            result.append(requirement)
+    return result
+
+
+def create_venv(env_dir=ENV_DIR, wheelhouse=WHEELHOUSE, stdout=None):
+    """
+    Create the venv; pip is upgraded from PyPI only when there is no
+    wheelhouse to install from. stdout is where pip's output goes.
+    """
+    subprocess.run(["python3", "-m", "venv", str(env_dir)], check=True, stdout=stdout)
+    if not wheelhouse_lock(wheelhouse):
+        subprocess.run([str(Path(env_dir) / "bin" / "python"), "-m", "pip", "install", "--upgrade", "pip"],
+                       check=True, stdout=stdout)
+
+
+def ensure(env_dir=ENV_DIR, path=REQUIREMENTS_PATH, force=False, log=print, wheelhouse=WHEELHOUSE, stdout=None):
+    """
+    Make sure every requirement is installed in the venv, installing what is
+    missing in one pip run, unless the stamp shows nothing changed since the
+    last successful check (force ignores the stamp). With a wheelhouse, pip
+    installs its locked wheels without contacting an index. Returns what was
+    installed; raises DepsError if the wheelhouse lacks a requirement. pip's
+    output goes to stdout (a file, e.g. sys.stderr) if given.
+    """
+    stamp = Path(env_dir) / STAMP_NAME
+    lock = wheelhouse_lock(wheelhouse)
+    digest = stamp_digest(env_dir, path, lock)
+    if not force and stamp.exists() and stamp.read_text() == digest:
+        return []
+    needed = missing(env_dir, path)
+    if needed:
+        pip = [str(Path(env_dir) / "bin" / "python"), "-m", "pip", "install"]
+        if lock:
+            log(f"Installing Python packages from {lock.parent}: {' '.join(needed)}")
+            # The whole lock, so dependencies come from the wheelhouse too; installed ones are skipped
+            subprocess.run(pip + ["--no-index", "--find-links", str(lock.parent), "--require-hashes",
+                                  "-r", str(lock)], check=True, stdout=stdout)
+        else:
+            log(f"Installing Python packages: {' '.join(needed)}")
+            subprocess.run(pip + needed, check=True, stdout=stdout)
+        # A lock older than requirements.txt installs fine but misses the new packages
+        still_missing = missing(env_dir, path)
+        if still_missing:
+            if lock:
+                raise DepsError(f"Wheelhouse {lock.parent} is out of date and lacks {' '.join(still_missing)}; "
+                                f"re-run bundle-deps")
+            raise DepsError(f"pip did not install {' '.join(still_missing)}")
+    stamp.write_text(digest)
+    return needed
+
+
+def build_wheelhouse(wheelhouse=WHEELHOUSE, path=REQUIREMENTS_PATH, python_version=None, env_dir=ENV_DIR):
+    """
+    Download pure-Python wheels of the requirements and their dependencies
+    into wheelhouse, replacing any older wheels, and write requirements.lock
+    pinning each by sha256. python_version ("3.11") is the target machines'
+    Python, by default the venv's. The existing wheelhouse is only replaced
+    once the download succeeded. Returns the lock path.
+    """
+    wheelhouse = Path(wheelhouse)
+    wheelhouse.mkdir(parents=True, exist_ok=True)
+    python = Path(env_dir) / "bin" / "python"
+    if not python.exists():
+        python = Path(sys.executable)
+    if not python_version:
+        python_version = subprocess.run([str(python), "-c", "import sys; print('%d.%d' % sys.version_info[:2])"],
+                                        capture_output=True, text=True, check=True).stdout.strip()
+    with tempfile.TemporaryDirectory(dir=wheelhouse, prefix=".download-") as tmp:
+        # Pure wheels only, so a wheelhouse built on a PC also installs on a Pi
+        subprocess.run([str(python), "-m", "pip", "download", "-r", str(path), "-d", tmp,
+                        "--only-binary=:all:", "--platform", "any", "--implementation", "py", "--abi", "none",
+                        "--python-version", python_version], check=True)
+        lines = []
+        wheels = sorted(Path(tmp).glob("*.whl"))
+        for wheel in wheels:
+            name, version = wheel.name.split("-")[:2]
+            digest = hashlib.sha256(wheel.read_bytes()).hexdigest()
+            lines.append(f"{name}=={version} --hash=sha256:{digest}")
+        # New wheels first, then the lock, then drop old wheels: the lock on disk
+        # always names wheels that are there
+        for wheel in wheels:
+            os.replace(wheel, wheelhouse / wheel.name)
+        lock = wheelhouse / LOCK_NAME
+        tmp_lock = Path(tmp) / LOCK_NAME
+        tmp_lock.write_text("".join(line + "\n" for line in lines))
+        os.replace(tmp_lock, lock)
+    keep = {wheel.name for wheel in wheels}
+    for old in wheelhouse.glob("*.whl"):
+        if old.name not in keep:
+            old.unlink()
+    return lock
@@ -0,0 +1,504 @@
+"""
+In-process DfuSe flasher for the STM32 ROM bootloader (0483:df11).
+
+Writes an ordered list of (address, image) segments in a single USB session,
+erasing only the flash pages the segments touch, instead of running one
+dfu-util process (and one enumeration) per image. Segments whose flash
+contents already match (read back over DFU upload) can be skipped, and
+written segments can be read back and verified.
+
+Given the board's USB serial, a record of the page hashes last written to
+it is kept under ~/.cache/openams/boards, so a later flash erases and
+programs only the pages that changed. A missing, interrupted or stale
+record falls back to writing every page the images cover.
+
+Requires pyusb and a libusb backend; callers should fall back to dfu-util
+when import_usb() raises ImportError.
+"""
+import hashlib
+import json
+import os
+import re
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+
+DFU_VENDOR_ID = 0x0483
+DFU_PRODUCT_ID = 0xdf11
+
+# DFU class requests
+DFU_DNLOAD = 1
+DFU_UPLOAD = 2
+DFU_GETSTATUS = 3
+DFU_CLRSTATUS = 4
+DFU_ABORT = 6
+REQUEST_OUT = 0x21  # class, interface, host to device
+REQUEST_IN = 0xa1   # class, interface, device to host
+
+# DFU states
+STATE_IDLE = 2
+STATE_DNBUSY = 4
+STATE_DNLOAD_IDLE = 5
+STATE_MANIFEST = 7
+STATE_UPLOAD_IDLE = 9
+STATE_ERROR = 10
+
+# DfuSe commands, sent as a DNLOAD with wValue=0
+DFUSE_SET_ADDRESS = 0x21
+DFUSE_ERASE = 0x41
+
+DFU_FUNCTIONAL_DESCRIPTOR = 0x21
+DEFAULT_TRANSFER_SIZE = 1024
+DEFAULT_PAGE_SIZE = 2048
+USB_TIMEOUT = 5000  # ms
+RECORD_DIR = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "openams" / "boards"
+
+
+class DfuError(Exception):
+    """Raised when the device reports an error or is in an unexpected state."""
+
+
+class VerifyError(DfuError):
+    """Raised when flash read back after writing differs from the image."""
+
+
+@dataclass
+class Segment:
+    """An image to write at a flash address."""
+    address: int
+    data: bytes
+    name: str = ""
+
+    @classmethod
+    def from_file(cls, address, path):
+        path = Path(path)
+        return cls(address, path.read_bytes(), path.name)
+
+
+@dataclass
+class FlashStats:
+    """Summary of a flashing session."""
+    bytes_written: int = 0
+    pages_erased: int = 0
+    transfer_size: int = 0
+    seconds: float = 0.0
+    segments: list = field(default_factory=list)
+    skipped: list = field(default_factory=list)
+    bytes_verified: int = 0
+    pages_unchanged: int = 0
+    differential: bool = False
+
+    @property
+    def throughput(self):
+        return self.bytes_written / self.seconds if self.seconds else 0.0
+
+
+def import_usb():
+    """Import pyusb, raising ImportError if it or a libusb backend is missing."""
+    import usb.backend.libusb1
+    import usb.core
+    import usb.util
+    if usb.backend.libusb1.get_backend() is None:
+        raise ImportError("libusb-1.0 backend not available")
+    return usb
+
+
+def parse_layout(description):
+    """
+    Parse a DfuSe memory layout string such as
+    "@Internal Flash  /0x08000000/64*02Kg" into a list of (start, size) pages.
+    """
+    match = re.search(r"/0x([0-9a-fA-F]+)/(.*)", description or "")
+    if not match:
+        return []
+    address = int(match.group(1), 16)
+    pages = []
+    for count, size, unit in re.findall(r"(\d+)\*(\d+)\s?([KMB ]?)[a-g]", match.group(2)):
+        size = int(size) * {"K": 1024, "M": 1024 * 1024}.get(unit, 1)
+        for _ in range(int(count)):
+            pages.append((address, size))
+            address += size
+    return pages
+
+
+class DfuSeDevice:
+    """A claimed DfuSe interface on an STM32 in ROM bootloader mode."""
+
+    def __init__(self, dev, interface=0, alt=0):
+        usb = import_usb()
+        self.usb = usb
+        self.dev = dev
+        self.interface = interface
+        if dev.is_kernel_driver_active(interface):
+            dev.detach_kernel_driver(interface)
+        usb.util.claim_interface(dev, interface)
+        dev.set_interface_altsetting(interface, alt)
+
+        intf = dev.get_active_configuration()[(interface, alt)]
+        self.layout = parse_layout(usb.util.get_string(dev, intf.iInterface)) if intf.iInterface else []
+        self.transfer_size = self._read_transfer_size(intf)
+
+    @classmethod
+    def open(cls, path=None):
+        """Open the DFU device at USB port path (e.g. "1-1.2"), or the first one found."""
+        usb = import_usb()
+
+        def match(dev):
+            if path is None:
+                return True
+            bus, _, ports = path.partition("-")
+            return dev.bus == int(bus) and ".".join(map(str, dev.port_numbers or ())) == ports
+
+        dev = usb.core.find(idVendor=DFU_VENDOR_ID, idProduct=DFU_PRODUCT_ID, custom_match=match)
+        if dev is None:
+            raise DfuError(f"No DFU device found at {path or 'any port'}")
+        return cls(dev)
+
+    def close(self):
+        self.usb.util.release_interface(self.dev, self.interface)
+        self.usb.util.dispose_resources(self.dev)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _read_transfer_size(self, intf):
+        for extra in (bytes(intf.extra_descriptors), bytes(self.dev.get_active_configuration().extra_descriptors)):
+            offset = 0
+            while offset + 2 <= len(extra):
+                length, kind = extra[offset], extra[offset + 1]
+                if length == 0:
+                    break
+                if kind == DFU_FUNCTIONAL_DESCRIPTOR and length >= 7:
+                    return int.from_bytes(extra[offset + 5:offset + 7], "little")
+                offset += length
+        return DEFAULT_TRANSFER_SIZE
+
+    # --- DFU primitives ---
+
+    def get_status(self):
+        """Return (status, state, poll_timeout_ms)."""
+        data = self.dev.ctrl_transfer(REQUEST_IN, DFU_GETSTATUS, 0, self.interface, 6, USB_TIMEOUT)
+        return data[0], data[4], data[1] | data[2] << 8 | data[3] << 16
+
+    def clear_status(self):
+        self.dev.ctrl_transfer(REQUEST_OUT, DFU_CLRSTATUS, 0, self.interface, None, USB_TIMEOUT)
+
+    def abort(self):
+        self.dev.ctrl_transfer(REQUEST_OUT, DFU_ABORT, 0, self.interface, None, USB_TIMEOUT)
+
+    def ensure_idle(self):
+        status, state, _ = self.get_status()
+        if state == STATE_ERROR:
+            self.clear_status()
+        elif state != STATE_IDLE:
+            self.abort()
+        status, state, _ = self.get_status()
+        if state != STATE_IDLE:
+            raise DfuError(f"Device not idle (state {state}, status {status})")
+
+    def _download(self, block, data):
+        self.dev.ctrl_transfer(REQUEST_OUT, DFU_DNLOAD, block, self.interface, data, USB_TIMEOUT)
+        status, state, poll = self.get_status()
+        while state == STATE_DNBUSY:
+            time.sleep(poll / 1000)
+            status, state, poll = self.get_status()
+        if status != 0 or state not in (STATE_DNLOAD_IDLE, STATE_MANIFEST):
+            raise DfuError(f"Download of block {block} failed (state {state}, status {status})")
+
+    def set_address(self, address):
+        self._download(0, bytes([DFUSE_SET_ADDRESS]) + address.to_bytes(4, "little"))
+
+    def erase_page(self, address):
+        self._download(0, bytes([DFUSE_ERASE]) + address.to_bytes(4, "little"))
+
+    def mass_erase(self):
+        self._download(0, bytes([DFUSE_ERASE]))
+
+    def page_size(self, start):
+        if self.layout:
+            return next(size for page, size in self.layout if page == start)
+        return DEFAULT_PAGE_SIZE
+
+    def pages_for(self, address, length):
+        """Return the start addresses of the flash pages overlapping [address, address+length)."""
+        end = address + length
+        if self.layout:
+            return [start for start, size in self.layout if start < end and start + size > address]
+        first = address - address % DEFAULT_PAGE_SIZE
+        return list(range(first, end, DEFAULT_PAGE_SIZE))
+
+    def write(self, address, data, progress=None):
+        """Write data at address (already erased), reporting progress(bytes_done)."""
+        self.set_address(address)
+        for offset in range(0, len(data), self.transfer_size):
+            # DfuSe data blocks start at wValue=2, relative to the address pointer
+            self._download(2 + offset // self.transfer_size, data[offset:offset + self.transfer_size])
+            if progress:
+                progress(min(offset + self.transfer_size, len(data)))
+
+    def read_chunks(self, address, length):
+        """Yield length bytes of flash from address, one transfer-size block at a time."""
+        self.set_address(address)
+        # Back to dfuIDLE; UPLOAD blocks are then relative to the address pointer
+        self.abort()
+        try:
+            for offset in range(0, length, self.transfer_size):
+                size = min(self.transfer_size, length - offset)
+                data = self.dev.ctrl_transfer(REQUEST_IN, DFU_UPLOAD, 2 + offset // self.transfer_size,
+                                              self.interface, size, USB_TIMEOUT)
+                if len(data) != size:
+                    raise DfuError(f"Short upload at 0x{address + offset:08x} ({len(data)} of {size} bytes)")
+                yield bytes(data)
+        finally:
+            try:
+                self.abort()
+            except self.usb.core.USBError:
+                pass  # Left in dfuERROR; ensure_idle() clears it
+
+    def read(self, address, length):
+        """Return length bytes of flash from address."""
+        return b"".join(self.read_chunks(address, length))
+
+    def matches(self, address, data):
+        """
+        Return True if flash at address already holds data. Compares block by
+        block as it reads, so a difference stops the upload early.
+        """
+        offset = 0
+        for chunk in self.read_chunks(address, len(data)):
+            if chunk != data[offset:offset + len(chunk)]:
+                return False
+            offset += len(chunk)
+        return True
+
+    def leave(self, address):
+        """Exit DFU and jump to address."""
+        self.set_address(address)
+        self.dev.ctrl_transfer(REQUEST_OUT, DFU_DNLOAD, 0, self.interface, None, USB_TIMEOUT)
+        try:
+            self.get_status()
+        except self.usb.core.USBError:
+            pass  # Device resets as it leaves DFU
+
+
+def _with_shared_pages(device, segments, pending):
+    """Add to pending any other segment sharing a flash page with it, since erasing that page would clobber it."""
+    pending = list(pending)
+    while True:
+        pages = {page for segment in pending for page in device.pages_for(segment.address, len(segment.data))}
+        extra = [segment for segment in segments
+                 if all(segment is not p for p in pending)
+                 and pages & set(device.pages_for(segment.address, len(segment.data)))]
+        if not extra:
+            return [segment for segment in segments if any(segment is p for p in pending)]
+        pending += extra
+
+
+def _record_path(serial):
+    return RECORD_DIR / f"{re.sub(r'[^A-Za-z0-9_.-]', '_', serial)}.json"
+
+
+def load_record(serial):
+    """Return the flash record for the board with USB serial, or None."""
+    try:
+        return json.loads(_record_path(serial).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def save_record(serial, record):
+    RECORD_DIR.mkdir(parents=True, exist_ok=True)
+    path = _record_path(serial)
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(record, indent=2))
+    os.replace(tmp, path)
+
+
+def forget(serial):
+    """Drop the flash record for serial, e.g. after the board was written by another tool."""
+    if serial:
+        _record_path(serial).unlink(missing_ok=True)
+
+
+def page_hashes(device, segments):
+    """
+    Return {page_start: sha256} for every page the segments touch, hashed as
+    the page reads after writing them (erased 0xff where no segment lands).
+    """
+    contents = {}
+    for segment in segments:
+        end = segment.address + len(segment.data)
+        for page in device.pages_for(segment.address, len(segment.data)):
+            if page not in contents:
+                contents[page] = bytearray(b"\xff" * device.page_size(page))
+            data = contents[page]
+            low, high = max(page, segment.address), min(page + len(data), end)
+            data[low - page:high - page] = segment.data[low - segment.address:high - segment.address]
+    return {page: hashlib.sha256(data).hexdigest() for page, data in contents.items()}
+
+
+def _record_current(device, record, targets):
+    """
+    Probe whether a complete record still describes the flash: read back one
+    page it claims is already up to date and compare its hash.
+    """
+    if not record or not record.get("complete"):
+        return False
+    unchanged = [page for page, digest in targets.items() if record["pages"].get(f"0x{page:08x}") == digest]
+    if not unchanged:
+        return True
+    page = unchanged[0]
+    try:
+        data = device.read(page, device.page_size(page))
+    except (DfuError, device.usb.core.USBError):
+        device.ensure_idle()
+        return False
+    return hashlib.sha256(data).hexdigest() == targets[page]
+
+
+def _identical(device, segment, segments, sizes):
+    """
+    True if flash already holds segment and no tail of a longer earlier image
+    follows it: its size must match the record (if there is one) and the rest
+    of its last page must be erased, unless another segment starts there.
+    """
+    if sizes is not None and sizes.get(f"0x{segment.address:08x}") != len(segment.data):
+        return False
+    end = segment.address + len(segment.data)
+    last = device.pages_for(segment.address, len(segment.data))[-1]
+    page_end = last + device.page_size(last)
+    if any(end <= other.address < page_end for other in segments if other is not segment):
+        page_end = end
+    return device.matches(segment.address, bytes(segment.data) + b"\xff" * (page_end - end))
+
+
+def _stale_tail(device, segments, pending, sizes):
+    """Pages a longer image recorded at a pending segment's address covered beyond the new one."""
+    covered = {page for segment in segments for page in device.pages_for(segment.address, len(segment.data))}
+    stale = set()
+    for segment in pending:
+        old = sizes.get(f"0x{segment.address:08x}", 0)
+        if old > len(segment.data):
+            stale.update(page for page in device.pages_for(segment.address, old) if page not in covered)
+    return stale
+
+
+def _runs(pages, device):
+    """Merge sorted page starts into contiguous (start, end) ranges."""
+    runs = []
+    for page in pages:
+        end = page + device.page_size(page)
+        if runs and runs[-1][1] == page:
+            runs[-1][1] = end
+        else:
+            runs.append([page, end])
+    return runs
+
+
+def flash(segments, path=None, mass_erase=False, progress=None, skip_identical=False, verify=False, serial=None):
+    """
+    Write segments (ordered Segment list) to the DFU device at path in one
+    session. Erases only the pages the segments touch unless mass_erase.
+    With skip_identical, segments already present in flash are left alone
+    (with mass_erase, only if every segment is). With verify, written
+    segments are read back and compared, raising VerifyError on a mismatch.
+    With serial (and no mass_erase), only pages that differ from the board's
+    flash record are erased and written, pages a longer previous image used
+    beyond a new one are erased, and the record is updated.
+    progress(segment, bytes_done) is called after every block.
+    Returns a FlashStats.
+    """
+    stats = FlashStats(segments=[segment.name for segment in segments])
+    start = time.monotonic()
+    with DfuSeDevice.open(path) as device:
+        stats.transfer_size = device.transfer_size
+        device.ensure_idle()
+        pending = segments
+        compared = False
+        record = load_record(serial) if serial else None
+        complete = record if record and record.get("complete") else None
+        # Image sizes from the last flash; a shorter image is not identical to a longer one it prefixes
+        sizes = complete.get("sizes", {}) if complete else None
+        if skip_identical:
+            try:
+                pending = [segment for segment in segments if not _identical(device, segment, segments, sizes)]
+                compared = True
+            except (DfuError, device.usb.core.USBError):
+                # Read-protected parts refuse UPLOAD; just write everything
+                device.ensure_idle()
+                pending = segments
+            if mass_erase and pending:
+                pending = segments
+            pending = _with_shared_pages(device, segments, pending)
+            skipped = [segment for segment in segments if all(segment is not p for p in pending)]
+            stats.skipped = [segment.name for segment in skipped]
+            for segment in skipped:
+                if progress:
+                    progress(segment, len(segment.data))
+
+        use_record = serial and not mass_erase
+        if serial and mass_erase:
+            forget(serial)
+        targets = page_hashes(device, segments) if use_record else {}
+        new_sizes = dict(sizes or {})
+        new_sizes.update({f"0x{segment.address:08x}": len(segment.data) for segment in segments})
+        if not pending:
+            if use_record:
+                # Flash was read back and matches; the record can be rebuilt from it
+                save_record(serial, {"complete": True, "written": time.time(), "sizes": new_sizes,
+                                     "pages": {f"0x{page:08x}": digest for page, digest in targets.items()}})
+            stats.seconds = time.monotonic() - start
+            return stats
+
+        pending_pages = {page for segment in pending for page in device.pages_for(segment.address, len(segment.data))}
+        changed = pending_pages
+        known = {}
+        stale = set()
+        if use_record:
+            if sizes:
+                stale = _stale_tail(device, segments, pending, sizes)
+            if _record_current(device, record, {page: targets[page] for page in pending_pages}):
+                known = record["pages"]
+                changed = {page for page in pending_pages if known.get(f"0x{page:08x}") != targets[page]}
+                if compared and not changed:
+                    # Read-back says a segment differs, the record says nothing does: stale
+                    changed, known = pending_pages, {}
+            stats.differential = bool(known)
+            stats.pages_unchanged = len(pending_pages - changed)
+            known = {page: digest for page, digest in known.items() if int(page, 16) not in stale}
+            # An interrupted flash leaves the record incomplete, forcing a full write next time
+            save_record(serial, {"complete": False, "written": time.time(), "pages": known})
+
+        if mass_erase:
+            device.mass_erase()
+        else:
+            for page in sorted(changed | stale):
+                device.erase_page(page)
+            stats.pages_erased = len(changed | stale)
+        for segment in pending:
+            end = segment.address + len(segment.data)
+            pages = sorted(page for page in changed if page < end and page + device.page_size(page) > segment.address)
+            for low, high in _runs(pages, device):
+                low, high = max(low, segment.address), min(high, end)
+                offset = low - segment.address
+                device.write(
+                    low, segment.data[offset:high - segment.address],
+                    progress=(lambda done, segment=segment, offset=offset: progress(segment, offset + done)) if progress else None
+                )
+                stats.bytes_written += high - low
+            if progress:
+                progress(segment, len(segment.data))
+        if verify:
+            for segment in pending:
+                if not device.matches(segment.address, segment.data):
+                    raise VerifyError(f"Read-back of {segment.name or 'segment'} at 0x{segment.address:08x} does not match the image")
+                stats.bytes_verified += len(segment.data)
+        if use_record:
+            pages = dict(known)
+            pages.update({f"0x{page:08x}": digest for page, digest in targets.items()})
+            save_record(serial, {"complete": True, "written": time.time(), "sizes": new_sizes, "pages": pages})
+    stats.seconds = time.monotonic() - start
+    return stats
@@ -0,0 +1,104 @@
+"""
+Index of the prebuilt OpenAMS Mainboard images in firmwares/openams.
+
+firmwares/openams/index.json lists every image with its version, SHA-256,
+size and flash address, and each oams application names the kancan
+bootloader versions it runs on. Deploy picks the newest compatible pair by
+looking it up in the index instead of globbing and parsing file names, and
+checks both images against their recorded hash before a DFU session starts.
+Standard library only.
+"""
+import hashlib
+import json
+import mmap
+from pathlib import Path
+
+INDEX_FILE = "index.json"
+INDEX_FORMAT = 1
+BOOTLOADER = "kancan"
+APPLICATION = "oams"
+
+
+class FirmwareError(Exception):
+    """Raised when the index is missing or malformed, or an image fails its check."""
+
+
+def sha256_file(path):
+    """SHA-256 of the file at path, hashed from a read-only mmap."""
+    with open(path, "rb") as f:
+        if Path(path).stat().st_size == 0:
+            return hashlib.sha256().hexdigest()
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return hashlib.sha256(data).hexdigest()
+
+
+def version_tuple(version):
+    return tuple(int(part) for part in version.split("."))
+
+
+def load_index(fw_dir):
+    """Return the parsed index of fw_dir, raising FirmwareError if it is missing or invalid."""
+    path = Path(fw_dir) / INDEX_FILE
+    try:
+        index = json.loads(path.read_text())
+    except OSError:
+        raise FirmwareError(f"Firmware index {path} not found")
+    except ValueError as e:
+        raise FirmwareError(f"Firmware index {path} is not valid JSON: {e}")
+    if index.get("format") != INDEX_FORMAT:
+        raise FirmwareError(f"Unsupported firmware index format {index.get('format')!r} in {path}")
+    for image in index.get("images", []):
+        missing = {"name", "version", "file", "address", "size", "sha256"} - set(image)
+        if missing:
+            raise FirmwareError(f"Index entry {image.get('file', '?')} lacks {', '.join(sorted(missing))}")
+    return index
+
+
+def verify(fw_dir, image):
+    """Check an index entry's file against its recorded size and SHA-256; return its path."""
+    path = Path(fw_dir) / image["file"]
+    if not path.exists():
+        raise FirmwareError(f"{image['file']} is listed in the firmware index but missing")
+    size = path.stat().st_size
+    if size != image["size"]:
+        raise FirmwareError(f"{image['file']} is {size} bytes, the index says {image['size']}; refusing to flash it")
+    if sha256_file(path) != image["sha256"]:
+        raise FirmwareError(f"{image['file']} does not match its SHA-256 in the index; refusing to flash it")
+    return path
+
+
+def select(index):
+    """
+    Return (bootloader, application) index entries: the newest oams image
+    that has a compatible kancan in the index, paired with the newest such
+    kancan. Raises FirmwareError if no compatible pair exists.
+    """
+    images = index.get("images", [])
+    bootloaders = {image["version"]: image for image in images if image["name"] == BOOTLOADER}
+    applications = sorted((image for image in images if image["name"] == APPLICATION),
+                          key=lambda image: version_tuple(image["version"]), reverse=True)
+    for application in applications:
+        compatible = [bootloaders[v] for v in application.get("bootloaders", []) if v in bootloaders]
+        if compatible:
+            bootloader = max(compatible, key=lambda image: version_tuple(image["version"]))
+            return bootloader, application
+    raise FirmwareError(f"No {APPLICATION} image in the firmware index has a compatible {BOOTLOADER} bootloader")
+
+
+def refresh(fw_dir):
+    """
+    Recompute size and SHA-256 of every indexed image in fw_dir and write the
+    index back. Returns the .bin files present but not indexed, which need an
+    entry (version, address, bootloaders) added by hand.
+    """
+    fw_dir = Path(fw_dir)
+    index = load_index(fw_dir)
+    for image in index["images"]:
+        path = fw_dir / image["file"]
+        if not path.exists():
+            raise FirmwareError(f"{image['file']} is listed in the firmware index but missing")
+        image["size"] = path.stat().st_size
+        image["sha256"] = sha256_file(path)
+    (fw_dir / INDEX_FILE).write_text(json.dumps(index, indent=2) + "\n")
+    indexed = {image["file"] for image in index["images"]}
+    return sorted(path.name for path in fw_dir.glob("*.bin") if path.name not in indexed)
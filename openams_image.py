@@ -0,0 +1,115 @@
+"""
+Pre-flash sanity checks for STM32 firmware images.
+
+Before a DFU session starts, each image is memory-mapped and its Cortex-M
+vector table checked: the initial stack pointer must lie in RAM and the
+reset handler must be a Thumb address inside the image. Images must also
+fit their flash slot (a bootloader ends where the next image starts) and
+must not overlap. A truncated or oversized .bin is rejected in microseconds
+instead of failing on the board. Standard library only.
+"""
+import mmap
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+
+VECTOR_TABLE_FMT = "<II"
+VECTOR_TABLE_SIZE = struct.calcsize(VECTOR_TABLE_FMT)
+
+
+class ImageError(Exception):
+    """Raised when one or more images fail validation; the message lists every problem."""
+
+
+@dataclass
+class MemoryMap:
+    """Flash and RAM ranges of the target MCU."""
+    flash_start: int = 0x08000000
+    flash_size: int = 0x20000
+    ram_start: int = 0x20000000
+    ram_size: int = 0x24000
+
+    @property
+    def flash_end(self):
+        return self.flash_start + self.flash_size
+
+    @property
+    def ram_end(self):
+        return self.ram_start + self.ram_size
+
+    @classmethod
+    def from_config(cls, path):
+        """
+        Read CONFIG_FLASH_START/SIZE and CONFIG_RAM_START/SIZE from a Kconfig
+        .config; values it does not set keep the STM32G0B1 defaults.
+        """
+        keys = {
+            "CONFIG_FLASH_START": "flash_start",
+            "CONFIG_FLASH_SIZE": "flash_size",
+            "CONFIG_RAM_START": "ram_start",
+            "CONFIG_RAM_SIZE": "ram_size",
+        }
+        values = {}
+        for line in Path(path).read_text().splitlines():
+            key, sep, value = line.partition("=")
+            if sep and key in keys:
+                values[keys[key]] = int(value, 0)
+        return cls(**values)
+
+
+def _vector_table(path):
+    with open(path, "rb") as f:
+        if Path(path).stat().st_size < VECTOR_TABLE_SIZE:
+            return None
+        with mmap.mmap(f.fileno(), VECTOR_TABLE_SIZE, access=mmap.ACCESS_READ) as data:
+            return struct.unpack_from(VECTOR_TABLE_FMT, data)
+
+
+def check_image(address, path, slot_end, memory, next_name=None):
+    """
+    Return a list of problems with the image at path to be written at
+    address. next_name names the image that starts at slot_end, if any.
+    """
+    name = Path(path).name
+    size = Path(path).stat().st_size
+    end = address + size
+    problems = []
+    if not memory.flash_start <= address < memory.flash_end:
+        problems.append(f"{name}: address 0x{address:08x} is outside flash")
+    if end > slot_end:
+        limit = f"overlap {next_name} at" if next_name else "overrun flash ending at"
+        problems.append(f"{name}: {size} bytes at 0x{address:08x} {limit} 0x{slot_end:08x} by {end - slot_end} bytes")
+
+    vectors = _vector_table(path)
+    if vectors is None:
+        problems.append(f"{name}: {size} bytes is too small to hold a vector table (truncated?)")
+        return problems
+    stack_pointer, reset = vectors
+    if not memory.ram_start < stack_pointer <= memory.ram_end or stack_pointer % 4:
+        problems.append(f"{name}: initial stack pointer 0x{stack_pointer:08x} is not inside RAM "
+                        f"0x{memory.ram_start:08x}-0x{memory.ram_end:08x}")
+    if not reset & 1:
+        problems.append(f"{name}: reset handler 0x{reset:08x} lacks the Thumb bit")
+    elif not address <= reset & ~1 < end:
+        problems.append(f"{name}: reset handler 0x{reset:08x} points outside the image "
+                        f"(0x{address:08x}-0x{end:08x}); wrong offset or not a firmware image?")
+    return problems
+
+
+def validate(images, memory=None):
+    """
+    Check [(address, path)] images destined for one board. Each image's slot
+    runs up to the next image's address (so a bootloader may not overlap the
+    application), or the end of flash for the last. Raises ImageError listing
+    every problem found.
+    """
+    memory = memory or MemoryMap()
+    images = sorted(images, key=lambda image: image[0])
+    problems = []
+    for i, (address, path) in enumerate(images):
+        if i + 1 < len(images):
+            problems += check_image(address, path, images[i + 1][0], memory, Path(images[i + 1][1]).name)
+        else:
+            problems += check_image(address, path, memory.flash_end, memory)
+    if problems:
+        raise ImageError("\n".join(problems))
@@ -0,0 +1,204 @@
+"""
+rtnetlink link monitoring for CAN interfaces.
+
+Listens on the RTMGRP_LINK multicast group so callers learn about CAN
+interfaces appearing, disappearing, and going up or down as it happens,
+instead of polling `ip link show can0`. Standard library only.
+"""
+import errno
+import socket
+import struct
+import time
+from dataclasses import dataclass
+
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 0x1
+
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+RTM_NEWLINK = 16
+RTM_DELLINK = 17
+RTM_GETLINK = 18
+NLM_F_REQUEST = 0x1
+NLM_F_DUMP = 0x300
+
+IFLA_IFNAME = 3
+IFLA_OPERSTATE = 16
+IFLA_LINKINFO = 18
+IFLA_INFO_KIND = 1
+IFLA_INFO_DATA = 2
+IFLA_CAN_BITTIMING = 1
+IFLA_CAN_STATE = 4
+
+IFF_UP = 0x1
+IFF_RUNNING = 0x40
+
+NLMSGHDR_FMT = "=LHHLL"
+IFINFOMSG_FMT = "=BxHiII"
+RTATTR_FMT = "=HH"
+NLMSGHDR_SIZE = struct.calcsize(NLMSGHDR_FMT)
+IFINFOMSG_SIZE = struct.calcsize(IFINFOMSG_FMT)
+RTATTR_SIZE = struct.calcsize(RTATTR_FMT)
+
+OPERSTATES = ["UNKNOWN", "NOTPRESENT", "DOWN", "LOWERLAYERDOWN", "TESTING", "DORMANT", "UP"]
+CAN_STATES = ["ERROR-ACTIVE", "ERROR-WARNING", "ERROR-PASSIVE", "BUS-OFF", "STOPPED", "SLEEPING"]
+CAN_KINDS = ("can", "vcan")
+
+
+@dataclass
+class LinkState:
+    """Snapshot of a network link as reported by rtnetlink."""
+    name: str
+    index: int
+    kind: str
+    operstate: str
+    up: bool
+    bitrate: int = 0
+    can_state: str = ""
+
+
+def _align(length):
+    return (length + 3) & ~3
+
+
+def _attributes(data):
+    """Yield (type, payload) for each rtattr in data."""
+    offset = 0
+    while offset + RTATTR_SIZE <= len(data):
+        length, attr_type = struct.unpack_from(RTATTR_FMT, data, offset)
+        if length < RTATTR_SIZE:
+            break
+        # Mask NLA_F_NESTED / NLA_F_NET_BYTEORDER
+        yield attr_type & 0x3fff, data[offset + RTATTR_SIZE:offset + length]
+        offset += _align(length)
+
+
+def _parse_link(payload):
+    _, _, index, flags, _ = struct.unpack_from(IFINFOMSG_FMT, payload)
+    name, kind, operstate, bitrate, can_state = "", "", "UNKNOWN", 0, ""
+    for attr_type, value in _attributes(payload[IFINFOMSG_SIZE:]):
+        if attr_type == IFLA_IFNAME:
+            name = value.rstrip(b"\0").decode()
+        elif attr_type == IFLA_OPERSTATE and value:
+            operstate = OPERSTATES[value[0]] if value[0] < len(OPERSTATES) else "UNKNOWN"
+        elif attr_type == IFLA_LINKINFO:
+            for info_type, info in _attributes(value):
+                if info_type == IFLA_INFO_KIND:
+                    kind = info.rstrip(b"\0").decode()
+                elif info_type == IFLA_INFO_DATA:
+                    for can_type, can_value in _attributes(info):
+                        if can_type == IFLA_CAN_BITTIMING and len(can_value) >= 4:
+                            bitrate = struct.unpack_from("=I", can_value)[0]
+                        elif can_type == IFLA_CAN_STATE and len(can_value) >= 4:
+                            state = struct.unpack_from("=I", can_value)[0]
+                            can_state = CAN_STATES[state] if state < len(CAN_STATES) else "UNKNOWN"
+    up = operstate == "UP" or (operstate == "UNKNOWN" and flags & IFF_UP and flags & IFF_RUNNING)
+    return LinkState(name, index, kind, operstate, bool(up), bitrate, can_state)
+
+
+def _messages(data):
+    """Yield (msg_type, seq, payload) for each netlink message in data."""
+    offset = 0
+    while offset + NLMSGHDR_SIZE <= len(data):
+        length, msg_type, _, seq, _ = struct.unpack_from(NLMSGHDR_FMT, data, offset)
+        if length < NLMSGHDR_SIZE:
+            break
+        yield msg_type, seq, data[offset + NLMSGHDR_SIZE:offset + length]
+        offset += _align(length)
+
+
+def _open(groups=0):
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    try:
+        sock.bind((0, groups))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _request_dump(sock, seq):
+    request = struct.pack(IFINFOMSG_FMT, socket.AF_UNSPEC, 0, 0, 0, 0)
+    header = struct.pack(NLMSGHDR_FMT, NLMSGHDR_SIZE + len(request), RTM_GETLINK,
+                         NLM_F_REQUEST | NLM_F_DUMP, seq, 0)
+    sock.send(header + request)
+
+
+def list_links(kinds=CAN_KINDS):
+    """Return the current LinkState of every link whose kind is in kinds (None for all)."""
+    links = []
+    with _open() as sock:
+        seq = int(time.time())
+        _request_dump(sock, seq)
+        while True:
+            for msg_type, msg_seq, payload in _messages(sock.recv(65536)):
+                if msg_seq != seq:
+                    continue
+                if msg_type == NLMSG_DONE:
+                    return links
+                if msg_type == NLMSG_ERROR:
+                    code = -struct.unpack_from("=i", payload)[0]
+                    raise OSError(code, errno.errorcode.get(code, "netlink error"))
+                if msg_type == RTM_NEWLINK:
+                    link = _parse_link(payload)
+                    if kinds is None or link.kind in kinds:
+                        links.append(link)
+
+
+def get_link(name):
+    """Return the LinkState of interface name, or None if it does not exist."""
+    return next((link for link in list_links(kinds=None) if link.name == name), None)
+
+
+def watch_links(kinds=CAN_KINDS, timeout=None):
+    """
+    Yield (event, LinkState) for links whose kind is in kinds. Links present
+    when the watch starts are reported as "added" first; after that events
+    are "added", "removed", "up", "down" or "changed" (bitrate/CAN state).
+    Returns once timeout seconds have passed, if given.
+    """
+    known = {}
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    with _open(RTMGRP_LINK) as sock:
+        # Subscribe first, then dump, so no change can slip in between
+        _request_dump(sock, int(time.time()))
+        while True:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                sock.settimeout(remaining)
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                return
+            for msg_type, _, payload in _messages(data):
+                if msg_type not in (RTM_NEWLINK, RTM_DELLINK):
+                    continue
+                link = _parse_link(payload)
+                previous = known.get(link.index)
+                if msg_type == RTM_DELLINK:
+                    if previous is not None:
+                        del known[link.index]
+                        yield "removed", previous
+                    continue
+                if kinds is not None and link.kind not in kinds:
+                    continue
+                known[link.index] = link
+                if previous is None:
+                    yield "added", link
+                elif previous.up != link.up:
+                    yield ("up" if link.up else "down"), link
+                elif previous != link:
+                    yield "changed", link
+
+
+def wait_for_link(name, up=False, timeout=None):
+    """
+    Block until interface name exists (and, with up, is operationally up).
+    Returns its LinkState, or None if timeout seconds pass first.
+    """
+    for event, link in watch_links(kinds=None, timeout=timeout):
+        if event != "removed" and link.name == name and (link.up or not up):
+            return link
+    return None
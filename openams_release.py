@@ -0,0 +1,140 @@
+"""
+Prebuilt FPS firmware bundles.
+
+`openams_cli.py release` builds every .config-* variant once (typically on a
+workstation) and writes the images plus a manifest.json with their SHA-256,
+flash address and source commits into a versioned directory or tarball.
+`deploy --from-artifacts` flashes straight from such a bundle, so the
+printer's Pi needs neither git nor a toolchain. Standard library only.
+"""
+import atexit
+import hashlib
+import json
+import shutil
+import tarfile
+import tempfile
+import time
+from pathlib import Path
+
+MANIFEST_FILE = "manifest.json"
+BUNDLE_FORMAT = 1
+MODES = ("bridge", "canbus")
+# Katapult sits at the start of flash, Klipper after its 8KiB
+FPS_ADDRESSES = {
+    "katapult": 0x08000000,
+    "klipper": 0x08002000,
+}
+
+
+class BundleError(Exception):
+    """Raised when a bundle is missing, malformed or fails its hash check."""
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def bundle_name(version):
+    return f"openams-fps-{version}"
+
+
+def write_bundle(output_dir, version, images, toolchain=""):
+    """
+    Copy images into output_dir/openams-fps-<version>/ and write its manifest.
+    images is a list of dicts with project, mode, path and (optionally)
+    commit and config_sha256. Returns the bundle directory.
+    """
+    bundle_dir = Path(output_dir) / bundle_name(version)
+    if bundle_dir.exists():
+        shutil.rmtree(bundle_dir)
+    bundle_dir.mkdir(parents=True)
+    entries = []
+    for image in images:
+        name = f"{image['project']}-{image['mode']}.bin"
+        shutil.copyfile(image["path"], bundle_dir / name)
+        entries.append({
+            "project": image["project"],
+            "mode": image["mode"],
+            "file": name,
+            "address": f"0x{FPS_ADDRESSES[image['project']]:08x}",
+            "size": (bundle_dir / name).stat().st_size,
+            "sha256": sha256_file(bundle_dir / name),
+            "commit": image.get("commit", ""),
+            "config_sha256": image.get("config_sha256", ""),
+        })
+    manifest = {
+        "format": BUNDLE_FORMAT,
+        "board": "fps",
+        "version": version,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "toolchain": toolchain,
+        "images": entries,
+    }
+    (bundle_dir / MANIFEST_FILE).write_text(json.dumps(manifest, indent=2) + "\n")
+    return bundle_dir
+
+
+def make_tarball(bundle_dir):
+    """Pack bundle_dir into <bundle_dir>.tar.gz next to it and return the tarball path."""
+    bundle_dir = Path(bundle_dir)
+    tarball = bundle_dir.with_name(bundle_dir.name + ".tar.gz")
+    with tarfile.open(tarball, "w:gz") as tar:
+        tar.add(bundle_dir, arcname=bundle_dir.name)
+    return tarball
+
+
+def _extract(tarball):
+    target = Path(tempfile.mkdtemp(prefix="openams-bundle-"))
+    atexit.register(shutil.rmtree, target, True)
+    with tarfile.open(tarball) as tar:
+        if hasattr(tarfile, "data_filter"):
+            tar.extractall(target, filter="data")
+        else:
+            for member in tar.getmembers():
+                if not (member.isfile() or member.isdir()) or member.name.startswith("/") or ".." in Path(member.name).parts:
+                    raise BundleError(f"Refusing to extract unsafe member {member.name} from {tarball}")
+            tar.extractall(target)
+    return target
+
+
+def open_bundle(path):
+    """
+    Return (bundle_dir, manifest) for a bundle directory or .tar.gz, after
+    checking every image against its recorded size and SHA-256.
+    """
+    path = Path(path)
+    if not path.exists():
+        raise BundleError(f"{path} does not exist")
+    root = _extract(path) if path.is_file() else path
+    manifests = [root / MANIFEST_FILE] if (root / MANIFEST_FILE).exists() else list(root.glob(f"*/{MANIFEST_FILE}"))
+    if len(manifests) != 1:
+        raise BundleError(f"No single {MANIFEST_FILE} found in {path}")
+    bundle_dir = manifests[0].parent
+    try:
+        manifest = json.loads(manifests[0].read_text())
+    except ValueError as e:
+        raise BundleError(f"Invalid {MANIFEST_FILE} in {path}: {e}")
+    if manifest.get("format") != BUNDLE_FORMAT:
+        raise BundleError(f"Unsupported bundle format {manifest.get('format')!r} in {path}")
+
+    for image in manifest.get("images", []):
+        image_path = bundle_dir / image["file"]
+        if not image_path.exists():
+            raise BundleError(f"{image['file']} listed in the manifest is missing from {path}")
+        if image_path.stat().st_size != image["size"] or sha256_file(image_path) != image["sha256"]:
+            raise BundleError(f"{image['file']} does not match its manifest hash; the bundle is corrupted")
+    return bundle_dir, manifest
+
+
+def images_for(bundle_dir, manifest, mode):
+    """Return [(address, path)] for mode, bootloader first, or raise BundleError if incomplete."""
+    images = {image["project"]: image for image in manifest.get("images", []) if image["mode"] == mode}
+    missing = [project for project in FPS_ADDRESSES if project not in images]
+    if missing:
+        raise BundleError(f"Bundle {manifest.get('version')} has no {', '.join(missing)} image for {mode} mode")
+    return [(int(images[project]["address"], 16), Path(bundle_dir) / images[project]["file"])
+            for project in FPS_ADDRESSES]
@@ -0,0 +1,324 @@
+"""
+Git sync for the Katapult and Klipper source trees.
+
+New trees are cloned shallow (--depth 1) instead of with full history, and
+can be pinned to a tested tag or full commit id. A local bare
+mirror, a `git bundle` file, or a LAN git server can stand in for GitHub
+(OPENAMS_GIT_MIRROR), so a fleet of printers syncs from one cache. Existing
+trees are fast-forwarded; a tree already at its pin needs no network.
+
+Each successful sync is recorded (time and commit) in
+~/.cache/openams/sync.json. Within the freshness TTL, or offline, a tree
+that is still at its recorded commit is used as is with no network access.
+"""
+import os
+import json
+import re
+import shutil
+import subprocess
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+import openams_build
+
+# Directory holding <name>.git mirrors or <name>.bundle files, or a base URL
+MIRROR = os.environ.get("OPENAMS_GIT_MIRROR")
+COMMIT_RE = re.compile(r"^[0-9a-f]{40}$")
+PIN_REF = "refs/openams/pin"
+STATE_PATH = Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "openams" / "sync.json"
+# Seconds a successful sync stays fresh; 0 syncs every time
+SYNC_TTL = float(os.environ.get("OPENAMS_SYNC_TTL", 900))
+# Upper bound on one tree's sync and on how many trees sync at once
+SYNC_TIMEOUT = float(os.environ.get("OPENAMS_SYNC_TIMEOUT", 120))
+SYNC_JOBS = 3
+_state_lock = threading.Lock()
+# Deadline of the sync running in this thread, applied to each git command
+_local = threading.local()
+
+
+@dataclass
+class Source:
+    """
+    A git tree to keep in sync: name (e.g. "klipper"), upstream url, checkout
+    path and optional tag/commit pin. A url of None means an existing
+    checkout that is pulled from its own upstream (e.g. this repository).
+    """
+    name: str
+    url: str
+    path: Path
+    ref: str = None
+
+
+@dataclass
+class SyncResult:
+    """Outcome of syncing one Source."""
+    name: str
+    action: str = ""
+    commit: str = ""
+    origin: str = ""
+    seconds: float = 0.0
+    error: str = ""
+
+    @property
+    def ok(self):
+        return not self.error
+
+
+class SyncError(Exception):
+    """Raised when a git command needed for a sync fails."""
+
+
+def _remaining():
+    deadline = getattr(_local, "deadline", None)
+    if deadline is None:
+        return None
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise subprocess.TimeoutExpired("git", 0)
+    return remaining
+
+
+def _git(path, *args, output=None):
+    # Never stop to ask for credentials; a private or mistyped URL should just fail
+    env = dict(os.environ, GIT_TERMINAL_PROMPT="0")
+    returncode, _ = openams_build.run_command(["git", "-C", str(path)] + list(args), output=output,
+                                              timeout=_remaining(), env=env)
+    if returncode != 0:
+        raise SyncError(f"git {' '.join(args)} failed in {path} (exit {returncode})")
+
+
+def _rev_parse(path, rev):
+    result = subprocess.run(["git", "-C", str(path), "rev-parse", "--verify", "--quiet", f"{rev}^{{commit}}"],
+                            capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else ""
+
+
+def load_state():
+    """Return {checkout path: {"time", "commit", "ref", "origin"}} for past successful syncs."""
+    try:
+        return json.loads(STATE_PATH.read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def _record_sync(source, result):
+    with _state_lock:
+        state = load_state()
+        state[str(source.path)] = {"time": time.time(), "commit": result.commit, "ref": source.ref, "origin": result.origin}
+        STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp = STATE_PATH.with_suffix(".tmp")
+        tmp.write_text(json.dumps(state, indent=2))
+        os.replace(tmp, STATE_PATH)
+
+
+def last_sync(source):
+    """Return the recorded last successful sync of source, or None."""
+    return load_state().get(str(source.path))
+
+
+def is_fresh(source, ttl=SYNC_TTL):
+    """True if source was synced less than ttl seconds ago and is still at that commit with the same pin."""
+    entry = last_sync(source)
+    if not ttl or not entry or entry.get("ref") != source.ref:
+        return False
+    return time.time() - entry["time"] < ttl and entry["commit"] == _rev_parse(source.path, "HEAD")
+
+
+def mirror_for(source, mirror=MIRROR):
+    """Return the mirror location (bare repo, bundle file or URL) to fetch source from, or None."""
+    if not mirror or source.url is None:
+        return None
+    if "://" in mirror or mirror.startswith("git@"):
+        return f"{mirror.rstrip('/')}/{source.name}.git"
+    for candidate in (Path(mirror) / f"{source.name}.git", Path(mirror) / f"{source.name}.bundle"):
+        if candidate.exists():
+            return str(candidate)
+    return None
+
+
+def _depth(remote):
+    # A bundle holds full history and cannot serve a shallow fetch
+    return [] if remote.endswith(".bundle") else ["--depth", "1"]
+
+
+def _shallow_args(source, remote, args):
+    # Bound fetches only for trees that are shallow already; never truncate a full clone
+    if remote.endswith(".bundle"):
+        return []
+    result = subprocess.run(["git", "-C", str(source.path), "rev-parse", "--is-shallow-repository"],
+                            capture_output=True, text=True)
+    return args if result.stdout.strip() == "true" else []
+
+
+def _default_branch(remote):
+    heads = subprocess.run(["git", "ls-remote", "--symref", remote, "HEAD"], capture_output=True, text=True,
+                           timeout=_remaining(), env=dict(os.environ, GIT_TERMINAL_PROMPT="0")).stdout
+    match = re.search(r"refs/heads/(\S+)\s+HEAD", heads)
+    return match.group(1) if match else "master"
+
+
+def _current_branch(path):
+    result = subprocess.run(["git", "-C", str(path), "symbolic-ref", "-q", "--short", "HEAD"],
+                            capture_output=True, text=True)
+    return result.stdout.strip()
+
+
+def _track(source, branch, output=None):
+    # Like clone --single-branch: a plain fetch or pull only ever touches this branch
+    _git(source.path, "update-ref", f"refs/remotes/origin/{branch}", "FETCH_HEAD", output=output)
+    _git(source.path, "config", "remote.origin.fetch", f"+refs/heads/{branch}:refs/remotes/origin/{branch}",
+         output=output)
+    _git(source.path, "config", f"branch.{branch}.remote", "origin", output=output)
+    _git(source.path, "config", f"branch.{branch}.merge", f"refs/heads/{branch}", output=output)
+
+
+def _checkout_pin(source, output=None):
+    _git(source.path, "checkout", "-q", "--detach", "FETCH_HEAD", output=output)
+    # Remember what the pin resolved to, so a later sync can tell it is already there
+    _git(source.path, "update-ref", PIN_REF, "HEAD", output=output)
+    _git(source.path, "config", "openams.pin", source.ref, output=output)
+
+
+def at_pin(source):
+    """True if source is checked out at its pin from an earlier sync."""
+    if not source.ref or not (source.path / ".git").exists():
+        return False
+    result = subprocess.run(["git", "-C", str(source.path), "config", "openams.pin"], capture_output=True, text=True)
+    head = _rev_parse(source.path, "HEAD")
+    return result.stdout.strip() == source.ref and _rev_parse(source.path, PIN_REF) == head \
+        or COMMIT_RE.match(source.ref) is not None and head == source.ref
+
+
+def _clone(source, remote, output=None):
+    source.path.mkdir(parents=True)
+    _git(source.path, "init", "-q", output=output)
+    _git(source.path, "remote", "add", "origin", source.url, output=output)
+    _git(source.path, "fetch", *_depth(remote), remote, source.ref or "HEAD", output=output)
+    if source.ref:
+        # A pinned tree fetches only its pin, never the upstream branches
+        _git(source.path, "config", "--unset-all", "remote.origin.fetch", output=output)
+        _checkout_pin(source, output=output)
+        return
+    # Unpinned: track the upstream default branch like a normal single-branch clone
+    branch = _default_branch(remote)
+    _git(source.path, "checkout", "-q", "-b", branch, "FETCH_HEAD", output=output)
+    _track(source, branch, output=output)
+
+
+def _update(source, remote, output=None):
+    if source.ref:
+        # Just the pinned commit, not the history between the old and the new pin
+        _git(source.path, "fetch", *_shallow_args(source, remote, ["--depth", "1"]), remote, source.ref,
+             output=output)
+        _checkout_pin(source, output=output)
+        return
+    if remote is None:
+        # An existing checkout with its own upstream (this repository)
+        _git(source.path, "pull", "--ff-only", output=output)
+        return
+    # Only the tracked branch, and only commits newer than the current tip, so
+    # a shallow tree stays shallow and connected for the fast-forward
+    branch = _current_branch(source.path)
+    detached = not branch
+    branch = branch or _default_branch(remote)
+    since = subprocess.run(["git", "-C", str(source.path), "log", "-1", "--format=%ct", "HEAD"],
+                           capture_output=True, text=True).stdout.strip()
+    _git(source.path, "fetch", *_shallow_args(source, remote, [f"--shallow-since={since}"] if since else []),
+         remote, f"refs/heads/{branch}", output=output)
+    if not detached:
+        _git(source.path, "merge", "--ff-only", "FETCH_HEAD", output=output)
+        _git(source.path, "update-ref", f"refs/remotes/origin/{branch}", "FETCH_HEAD", output=output)
+    else:
+        # Was pinned (detached); follow the default branch from here on
+        _git(source.path, "checkout", "-q", "-B", branch, "FETCH_HEAD", output=output)
+        _track(source, branch, output=output)
+
+
+def sync(source, mirror=MIRROR, output=None, ttl=SYNC_TTL, offline=False, timeout=None):
+    """
+    Clone or update source, fetching from the mirror when one holds it.
+    A tree synced less than ttl seconds ago (or any existing tree when
+    offline) is left alone without touching the network. The whole sync is
+    abandoned after timeout seconds. git output goes to output(line) if
+    given. Returns a SyncResult; failures are reported in it rather than
+    raised, so one bad tree does not stop others.
+    """
+    result = SyncResult(source.name)
+    start = time.monotonic()
+    remote = mirror_for(source, mirror) or source.url
+    result.origin = remote or "upstream"
+    exists = (source.path / ".git").exists()
+    if offline or (exists and is_fresh(source, ttl)):
+        if exists:
+            result.action = "offline" if offline else "fresh"
+        else:
+            result.action = "failed"
+            result.error = f"{source.path} does not exist and --offline forbids cloning it"
+        result.commit = _rev_parse(source.path, "HEAD") if exists else ""
+        result.seconds = time.monotonic() - start
+        return result
+    _local.deadline = time.monotonic() + timeout if timeout else None
+    try:
+        if not exists and source.url is None:
+            raise SyncError(f"{source.path} is not a git checkout")
+        if not exists:
+            result.action = "clone"
+            _clone(source, remote, output=output)
+            result.action = "cloned"
+        elif at_pin(source):
+            result.action = "at pin"
+        else:
+            before = _rev_parse(source.path, "HEAD")
+            _update(source, remote, output=output)
+            result.action = "updated" if _rev_parse(source.path, "HEAD") != before else "up to date"
+    except (SyncError, OSError, subprocess.TimeoutExpired) as e:
+        if result.action == "clone":
+            # Do not leave a half-initialised tree that later syncs would treat as a clone
+            shutil.rmtree(source.path, ignore_errors=True)
+        result.action = "failed"
+        result.error = f"timed out after {timeout:g}s" if isinstance(e, subprocess.TimeoutExpired) else str(e)
+    finally:
+        _local.deadline = None
+    result.commit = _rev_parse(source.path, "HEAD") if (source.path / ".git").exists() else ""
+    result.seconds = time.monotonic() - start
+    if result.ok:
+        _record_sync(source, result)
+    return result
+
+
+def sync_all(sources, jobs=SYNC_JOBS, output=None, **kwargs):
+    """
+    Sync sources concurrently, at most jobs at a time, and return their
+    SyncResults in the same order. output(source, line) receives git output;
+    other keyword arguments go to sync().
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def run(source):
+        line_output = (lambda line: output(source, line)) if output else None
+        return sync(source, output=line_output, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(sources)))) as pool:
+        return list(pool.map(run, sources))
+
+
+def update_mirror(source, mirror_dir, bundle=False, output=None):
+    """
+    Create or refresh a bare mirror of source in mirror_dir (and, with bundle,
+    a <name>.bundle next to it for copying to machines without network).
+    Returns the mirror path.
+    """
+    mirror_dir = Path(mirror_dir)
+    mirror_dir.mkdir(parents=True, exist_ok=True)
+    path = mirror_dir / f"{source.name}.git"
+    if path.exists():
+        _git(path, "remote", "update", "--prune", output=output)
+    else:
+        returncode, _ = openams_build.run_command(["git", "clone", "--mirror", source.url, str(path)], output=output)
+        if returncode != 0:
+            raise SyncError(f"git clone --mirror {source.url} failed (exit {returncode})")
+    if bundle:
+        _git(path, "bundle", "create", str(mirror_dir / f"{source.name}.bundle"), "--all", output=output)
+    return path
@@ -0,0 +1,174 @@
+"""
+USB device arrival detection via sysfs and kernel uevents.
+
+Finds STM32 DFU, Katapult and Klipper USB devices by reading
+/sys/bus/usb/devices and then listening on the kernel uevent netlink socket,
+so waiting for a board costs nothing until it actually shows up (no
+`sudo dfu-util -l` once per second). Standard library only.
+"""
+import socket
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_KERNEL_GROUP = 1
+SYSFS_USB = Path("/sys/bus/usb/devices")
+# Used only if the uevent socket cannot be opened (e.g. restricted containers)
+POLL_INTERVAL = 0.5
+
+DFU_ID = ("0483", "df11")
+KATAPULT_ID = ("1d50", "6177")
+KLIPPER_ID = ("1d50", "614e")
+USB_IDS = {
+    DFU_ID: "STM32 DFU",
+    KATAPULT_ID: "Katapult",
+    KLIPPER_ID: "Klipper",
+}
+
+
+@dataclass
+class UsbDevice:
+    """A USB device of interest, identified by its port path (e.g. "1-1.2")."""
+    path: str
+    vendor: str
+    product: str
+    busnum: int
+    devnum: int
+    serial: str
+    name: str
+
+    @property
+    def usb_id(self):
+        return self.vendor, self.product
+
+    def describe(self):
+        return f"{self.name} [{self.vendor}:{self.product}] at {self.path} (serial {self.serial or 'unknown'})"
+
+
+def _read_attr(device_dir, name):
+    try:
+        return (device_dir / name).read_text().strip()
+    except OSError:
+        return ""
+
+
+def read_device(device_dir, ids=USB_IDS):
+    """Return a UsbDevice for a sysfs device directory if its id is in ids."""
+    device_dir = Path(device_dir)
+    usb_id = (_read_attr(device_dir, "idVendor"), _read_attr(device_dir, "idProduct"))
+    if usb_id not in ids:
+        return None
+    return UsbDevice(
+        path=device_dir.name,
+        vendor=usb_id[0],
+        product=usb_id[1],
+        busnum=int(_read_attr(device_dir, "busnum") or 0),
+        devnum=int(_read_attr(device_dir, "devnum") or 0),
+        serial=_read_attr(device_dir, "serial"),
+        name=USB_IDS.get(usb_id, "USB device"),
+    )
+
+
+def list_devices(ids=USB_IDS):
+    """Return every attached USB device whose (vendor, product) is in ids."""
+    devices = []
+    if not SYSFS_USB.exists():
+        return devices
+    for entry in sorted(SYSFS_USB.iterdir()):
+        # Interfaces look like "1-1.2:1.0"; only whole devices matter here
+        if ":" in entry.name:
+            continue
+        device = read_device(entry, ids)
+        if device:
+            devices.append(device)
+    return devices
+
+
+def _open_uevent_socket():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+    try:
+        sock.bind((0, UEVENT_KERNEL_GROUP))
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def _parse_uevent(data):
+    """Parse a kernel uevent datagram ("add@/devices/...\\0KEY=VALUE\\0...") into a dict."""
+    fields = {}
+    for item in data.split(b"\0")[1:]:
+        key, sep, value = item.partition(b"=")
+        if sep:
+            fields[key.decode(errors="replace")] = value.decode(errors="replace")
+    return fields
+
+
+def watch_devices(ids=USB_IDS, timeout=None):
+    """
+    Yield ("add", UsbDevice) for devices already attached, then ("add"|"remove",
+    UsbDevice) as matching devices come and go. Returns after timeout seconds.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    try:
+        sock = _open_uevent_socket()
+    except OSError:
+        sock = None
+
+    known = {}
+    try:
+        # Subscribe before scanning so an arrival cannot fall in the gap
+        for device in list_devices(ids):
+            known[device.path] = device
+            yield "add", device
+
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+            if sock is None:
+                time.sleep(POLL_INTERVAL if remaining is None else min(POLL_INTERVAL, remaining))
+                current = {device.path: device for device in list_devices(ids)}
+                for path in list(known):
+                    if path not in current:
+                        yield "remove", known.pop(path)
+                for path, device in current.items():
+                    if path not in known:
+                        known[path] = device
+                        yield "add", device
+                continue
+
+            sock.settimeout(remaining)
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                return
+            event = _parse_uevent(data)
+            if event.get("SUBSYSTEM") != "usb" or event.get("DEVTYPE") != "usb_device":
+                continue
+            path = event.get("DEVPATH", "").rsplit("/", 1)[-1]
+            if event.get("ACTION") == "add" and path not in known:
+                device = read_device(Path("/sys") / event["DEVPATH"].lstrip("/"), ids)
+                if device:
+                    known[path] = device
+                    yield "add", device
+            elif event.get("ACTION") == "remove" and path in known:
+                yield "remove", known.pop(path)
+    finally:
+        if sock is not None:
+            sock.close()
+
+
+def wait_for_device(ids=(DFU_ID,), timeout=None, exclude=()):
+    """
+    Block until a device whose (vendor, product) is in ids is attached and
+    return it. Devices whose port path is in exclude are ignored. Returns None
+    if timeout seconds pass first.
+    """
+    for action, device in watch_devices(ids, timeout=timeout):
+        if action == "add" and device.path not in exclude:
+            return device
+    return None